@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import cv2
+import numpy
+
+import roop.globals
+from roop.core import decode_execution_providers, suggest_execution_providers
+from roop.face_analyser import get_one_face, get_many_faces, calculate_face_distance
+from roop.typing import Face, Frame
+from roop.utilities import has_image_extension, resolve_relative_path
+
+NAME = 'ROOP.BENCHMARK'
+SYNTHETIC_FRAME_TOTAL = 150
+SYNTHETIC_RESOLUTION = '1280x720'
+# SSIM 常数，按 8 位图像的取值范围计算
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def parse_args() -> argparse.Namespace:
+    program = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
+    program.add_argument('-s', '--source', help='select an source image', dest='source_path', required=True)
+    program.add_argument('-t', '--target', help='sample targets, images or videos', dest='target_paths', default=[], nargs='+')
+    program.add_argument('--synthetic-face', help='image animated into the synthetic target, defaults to the source image in which case the identity distance is not measured on it', dest='synthetic_face_path')
+    program.add_argument('--skip-synthetic', help='only benchmark the sample targets', dest='skip_synthetic', action='store_true')
+    program.add_argument('--baseline', help='arguments of the reference pipeline', dest='baseline', default='')
+    program.add_argument('--candidate', help='arguments of the candidate pipeline, e.g. "--model-variant int8 --keyframe-interval 4"', dest='candidate', required=True)
+    program.add_argument('--sample-interval', help='compute identity distance on every nth frame', dest='sample_interval', type=int, default=10)
+    program.add_argument('--output-directory', help='directory keeping the outputs of both pipelines', dest='output_directory')
+    program.add_argument('--report', help='write the results to this json file', dest='report_path')
+    program.add_argument('--execution-provider', help='execution provider used for the metrics', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
+    return program.parse_args()
+
+
+def update_status(message: str) -> None:
+    print(f'[{NAME}] {message}')
+
+
+"""
+    合成目标视频：把一张人脸图片缓慢推拉平移成视频，人脸的位置和大小逐帧变化
+"""
+def create_synthetic_target(face_path: str, output_directory: str) -> str:
+    target_path = os.path.join(output_directory, 'synthetic.mp4')
+    width, height = SYNTHETIC_RESOLUTION.split('x')
+    zoompan = f"zoompan=z='1+0.3*sin(on/50)':x='iw/2-(iw/zoom/2)+20*sin(on/20)':y='ih/2-(ih/zoom/2)':d={SYNTHETIC_FRAME_TOTAL}:s={SYNTHETIC_RESOLUTION}:fps=30"
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level, '-y', '-i', face_path]
+    # 先补边到目标宽高比，推拉时人脸不会被拉伸
+    commands.extend(['-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,{zoompan}'])
+    commands.extend(['-frames:v', str(SYNTHETIC_FRAME_TOTAL), '-c:v', 'libx264', '-pix_fmt', 'yuv420p', target_path])
+    subprocess.run(commands, check=True)
+    return target_path
+
+
+"""
+    以子进程运行一次完整流程，返回耗时，失败时返回 None
+"""
+def run_pipeline(source_path: str, target_path: str, output_path: str, arguments: str) -> Optional[float]:
+    commands = [sys.executable, resolve_relative_path('../run.py'), '-s', source_path, '-t', target_path, '-o', output_path]
+    commands.extend(shlex.split(arguments))
+    start_time = time.perf_counter()
+    process = subprocess.run(commands, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start_time
+    if process.returncode or not os.path.isfile(output_path):
+        return None
+    return elapsed
+
+
+"""
+    逐帧读取输出，图片视为只有一帧
+"""
+def read_output_frames(output_path: str) -> Iterator[Frame]:
+    if has_image_extension(output_path):
+        yield cv2.imread(output_path)
+        return
+    capture = cv2.VideoCapture(output_path)
+    while True:
+        has_frame, frame = capture.read()
+        if not has_frame:
+            break
+        yield frame
+    capture.release()
+
+
+"""
+    灰度图上的 SSIM，11x11 高斯窗口，σ = 1.5
+"""
+def calculate_ssim(frame: Frame, other_frame: Frame) -> float:
+    image = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(numpy.float64)
+    other_image = cv2.cvtColor(other_frame, cv2.COLOR_BGR2GRAY).astype(numpy.float64)
+    mean = cv2.GaussianBlur(image, (11, 11), 1.5)
+    other_mean = cv2.GaussianBlur(other_image, (11, 11), 1.5)
+    variance = cv2.GaussianBlur(image * image, (11, 11), 1.5) - mean * mean
+    other_variance = cv2.GaussianBlur(other_image * other_image, (11, 11), 1.5) - other_mean * other_mean
+    covariance = cv2.GaussianBlur(image * other_image, (11, 11), 1.5) - mean * other_mean
+    ssim_map = ((2 * mean * other_mean + SSIM_C1) * (2 * covariance + SSIM_C2)) / ((mean * mean + other_mean * other_mean + SSIM_C1) * (variance + other_variance + SSIM_C2))
+    return float(ssim_map.mean())
+
+
+"""
+    换脸后的人脸与源人脸的身份距离：取帧中与源人脸最接近的一张，距离与 --similar-face-distance 同一尺度
+"""
+def calculate_identity_distance(frame: Frame, source_face: Face) -> Optional[float]:
+    many_faces = get_many_faces(frame)
+    if not many_faces:
+        return None
+    return min(calculate_face_distance(face, source_face) for face in many_faces)
+
+
+"""
+    逐帧比较基线与候选输出：PSNR、SSIM，每隔若干帧计算两者与源人脸的身份距离，没有源人脸时不计算
+"""
+def compare_outputs(baseline_path: str, candidate_path: str, source_face: Optional[Face], sample_interval: int) -> Dict[str, Any]:
+    psnrs: List[float] = []
+    ssims: List[float] = []
+    baseline_distances: List[float] = []
+    candidate_distances: List[float] = []
+    for frame_number, (baseline_frame, candidate_frame) in enumerate(zip(read_output_frames(baseline_path), read_output_frames(candidate_path))):
+        if baseline_frame.shape != candidate_frame.shape:
+            candidate_frame = cv2.resize(candidate_frame, (baseline_frame.shape[1], baseline_frame.shape[0]))
+        psnrs.append(min(float(cv2.PSNR(baseline_frame, candidate_frame)), 100.0))
+        ssims.append(calculate_ssim(baseline_frame, candidate_frame))
+        if source_face and frame_number % sample_interval == 0:
+            baseline_distance = calculate_identity_distance(baseline_frame, source_face)
+            candidate_distance = calculate_identity_distance(candidate_frame, source_face)
+            if baseline_distance is not None and candidate_distance is not None:
+                baseline_distances.append(baseline_distance)
+                candidate_distances.append(candidate_distance)
+    return {
+        'frame_total': len(psnrs),
+        'psnr_mean': float(numpy.mean(psnrs)) if psnrs else None,
+        'psnr_min': float(numpy.min(psnrs)) if psnrs else None,
+        'ssim_mean': float(numpy.mean(ssims)) if ssims else None,
+        'ssim_min': float(numpy.min(ssims)) if ssims else None,
+        'baseline_identity_distance': float(numpy.mean(baseline_distances)) if baseline_distances else None,
+        'candidate_identity_distance': float(numpy.mean(candidate_distances)) if candidate_distances else None
+    }
+
+
+def benchmark_target(source_path: str, target_path: str, source_face: Optional[Face], output_directory: str, args: argparse.Namespace) -> Dict[str, Any]:
+    target_name, target_extension = os.path.splitext(os.path.basename(target_path))
+    baseline_path = os.path.join(output_directory, target_name + '-baseline' + target_extension)
+    candidate_path = os.path.join(output_directory, target_name + '-candidate' + target_extension)
+    update_status(f'Running baseline on {target_path}...')
+    baseline_time = run_pipeline(source_path, target_path, baseline_path, args.baseline)
+    update_status(f'Running candidate on {target_path}...')
+    candidate_time = run_pipeline(source_path, target_path, candidate_path, args.candidate)
+    result: Dict[str, Any] = {'target': target_path, 'baseline_time': baseline_time, 'candidate_time': candidate_time}
+    if baseline_time is None or candidate_time is None:
+        update_status(f'Pipeline failed on {target_path}, skipping metrics...')
+        return result
+    result['speedup'] = baseline_time / candidate_time
+    update_status(f'Comparing outputs of {target_path}...')
+    result.update(compare_outputs(baseline_path, candidate_path, source_face, max(args.sample_interval, 1)))
+    return result
+
+
+def format_metric(value: Optional[float], precision: int = 3) -> str:
+    if value is None:
+        return '-'
+    return f'{value:.{precision}f}'
+
+
+def report_results(results: List[Dict[str, Any]]) -> None:
+    for result in results:
+        update_status(
+            f'{result["target"]}: '
+            f'baseline {format_metric(result["baseline_time"], 1)}s, candidate {format_metric(result["candidate_time"], 1)}s, speedup {format_metric(result.get("speedup"), 2)}x, '
+            f'psnr {format_metric(result.get("psnr_mean"), 2)} dB (min {format_metric(result.get("psnr_min"), 2)}), '
+            f'ssim {format_metric(result.get("ssim_mean"))} (min {format_metric(result.get("ssim_min"))}), '
+            f'identity distance {format_metric(result.get("baseline_identity_distance"))} -> {format_metric(result.get("candidate_identity_distance"))}'
+        )
+
+
+"""
+    在同一批输入上运行基线与候选配置，报告加速比与质量指标
+"""
+def run() -> None:
+    args = parse_args()
+    roop.globals.execution_providers = decode_execution_providers(args.execution_provider)
+    source_face = get_one_face(cv2.imread(args.source_path))
+    if not source_face:
+        update_status('No face in source path detected.')
+        return
+    with tempfile.TemporaryDirectory() as temp_directory:
+        output_directory = args.output_directory or temp_directory
+        os.makedirs(output_directory, exist_ok=True)
+        results = [benchmark_target(args.source_path, target_path, source_face, output_directory, args) for target_path in args.target_paths]
+        if not args.skip_synthetic:
+            update_status('Creating synthetic target...')
+            synthetic_target_path = create_synthetic_target(args.synthetic_face_path or args.source_path, output_directory)
+            # 由源人脸生成的目标换脸前后都是源人脸，身份距离恒接近 0，没有意义
+            synthetic_source_face = source_face if args.synthetic_face_path else None
+            results.append(benchmark_target(args.source_path, synthetic_target_path, synthetic_source_face, output_directory, args))
+    report_results(results)
+    if args.report_path:
+        with open(args.report_path, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    run()
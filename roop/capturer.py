@@ -2,11 +2,12 @@ from typing import Optional
 import cv2
 
 from roop.typing import Frame
+from roop.utilities import get_video_metadata
 
 
 def get_video_frame(video_path: str, frame_number: int = 0) -> Optional[Frame]:
     capture = cv2.VideoCapture(video_path)
-    frame_total = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+    frame_total = get_video_metadata(video_path).frame_total
     capture.set(cv2.CAP_PROP_POS_FRAMES, min(frame_total, frame_number - 1))
     has_frame, frame = capture.read()
     capture.release()
@@ -16,7 +17,5 @@ def get_video_frame(video_path: str, frame_number: int = 0) -> Optional[Frame]:
 
 
 def get_video_frame_total(video_path: str) -> int:
-    capture = cv2.VideoCapture(video_path)
-    video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    capture.release()
-    return video_frame_total
+    return get_video_metadata(video_path).frame_total
+
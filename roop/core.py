@@ -8,23 +8,30 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List
+from typing import List, Optional
 import platform
 import signal
 import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import torch
 import onnxruntime
 if not 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
     del torch
-import tensorflow
 
 import roop.globals
 import roop.metadata
 import roop.ui as ui
+from roop.distributed import process_distributed, serve_worker
+from roop.execution import EXECUTION_PROFILES, MODEL_VARIANTS
+from roop.face_analyser import get_one_face
+from roop.face_index import prepare_face_index, save_face_index, clear_face_index
+from roop.output_cache import has_output_cache_inputs, get_output_cache_key, restore_cached_output, store_cached_output, get_output_cache_stats
 from roop.predictor import predict_image, predict_video
-from roop.processors.frame.core import get_frame_processors_modules
-from roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
+from roop.processors.frame.core import get_frame_processors_modules, clear_swapped_faces
+from roop.stream import process_stream, redirect_stream_stdout
+from roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, get_video_metadata, create_temp, move_temp, clean_temp, normalize_output_path, load_face_map, is_batch_target, get_batch_target_paths, select_temp_directory, get_temp_directory_path, get_trim_range, get_trim_frame_paths, splice_video, cancel_ffmpeg, clear_ffmpeg, get_ffmpeg_results
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
@@ -35,7 +42,7 @@ def parse_args() -> None:
     # 解析参数
     program = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
-    program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
+    program.add_argument('-t', '--target', help='select an target image, video, image directory or glob', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
     program.add_argument('--frame-processor', help='frame processors (choices: face_swapper, face_enhancer, ...)', dest='frame_processor', default=['face_swapper'], nargs='+')
     program.add_argument('--keep-fps', help='keep target fps', dest='keep_fps', action='store_true')
@@ -45,21 +52,61 @@ def parse_args() -> None:
     program.add_argument('--reference-face-position', help='position of the reference face', dest='reference_face_position', type=int, default=0)
     program.add_argument('--reference-frame-number', help='number of the reference frame', dest='reference_frame_number', type=int, default=0)
     program.add_argument('--similar-face-distance', help='face distance used for recognition', dest='similar_face_distance', type=float, default=0.85)
+    program.add_argument('--face-map', help='swap the source face onto the person shown in the reference image', dest='face_map', nargs=2, action='append', default=[], metavar=('SOURCE', 'REFERENCE'))
+    program.add_argument('--face-map-file', help='json file mapping source faces to reference faces', dest='face_map_path')
+    program.add_argument('--trim-frame-start', help='first frame of the target video to process', dest='trim_frame_start', type=int)
+    program.add_argument('--trim-frame-end', help='frame of the target video to stop processing at', dest='trim_frame_end', type=int)
+    program.add_argument('--keyframe-interval', help='fully swap every nth frame and carry the swapped face to the frames between', dest='keyframe_interval', type=int, default=1)
+    program.add_argument('--keyframe-motion-threshold', help='landmark motion relative to the face size that forces a full swap', dest='keyframe_motion_threshold', type=float, default=0.2)
+    program.add_argument('--face-index', help='reuse per-video face detections across runs', dest='face_index', action='store_true')
+    program.add_argument('--cache-directory', help='directory used for cached face indexes and outputs', dest='cache_directory', default=os.path.join(os.path.expanduser('~'), '.cache', 'roop'))
+    program.add_argument('--output-cache', help='reuse the output of identical jobs stored in the cache directory', dest='output_cache', action='store_true')
+    program.add_argument('--output-cache-size', help='maximum size of cached outputs in GB, least recently used outputs are evicted first', dest='output_cache_size', type=float, default=10)
+    program.add_argument('--model-mirror', help='directory or url serving the models and an optional SHA256SUMS before the upstream urls', dest='model_mirror')
     program.add_argument('--temp-frame-format', help='image format used for frame extraction', dest='temp_frame_format', default='png', choices=['jpg', 'png'])
     program.add_argument('--temp-frame-quality', help='image quality used for frame extraction', dest='temp_frame_quality', type=int, default=0, choices=range(101), metavar='[0-100]')
+    program.add_argument('--temp-directory', help='directory used for temporary frames, auto prefers tmpfs when the frames fit', dest='temp_directory')
     program.add_argument('--output-video-encoder', help='encoder used for the output video', dest='output_video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9', 'h264_nvenc', 'hevc_nvenc'])
     program.add_argument('--output-video-quality', help='quality used for the output video', dest='output_video_quality', type=int, default=35, choices=range(101), metavar='[0-100]')
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int)
     program.add_argument('--execution-provider', help='available execution provider (choices: cpu, ...)', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-profile', help='onnxruntime session profile, auto calibrates once per host', dest='execution_profile', default='default', choices=EXECUTION_PROFILES)
+    program.add_argument('--model-variant', help='model variant prepared and cached under models, checked against fp32 on the source face', dest='model_variant', default='fp32', choices=MODEL_VARIANTS)
+    program.add_argument('--face-enhancer-runtime', help='runtime of the face enhancer, auto exports GFPGAN to onnx once and falls back to torch', dest='face_enhancer_runtime', default='auto', choices=['auto', 'onnx', 'torch'])
+    program.add_argument('--face-enhancer-min-size', help='smallest face in pixels worth enhancing', dest='face_enhancer_min_size', type=int, default=32)
+    program.add_argument('--face-enhancer-max-size', help='largest face in pixels worth enhancing', dest='face_enhancer_max_size', type=int)
+    program.add_argument('--frame-prefetch-depth', help='number of frames decoded ahead per execution thread', dest='frame_prefetch_depth', type=int, default=4)
+    program.add_argument('--frame-write-depth', help='number of processed frames queued for writing per execution thread', dest='frame_write_depth', type=int, default=4)
+    program.add_argument('--workers', help='process frame ranges on worker nodes', dest='worker_addresses', default=[], nargs='+', metavar='HOST:PORT')
+    program.add_argument('--local-workers', help='number of local worker processes standing in for worker nodes', dest='local_workers', type=int, default=0)
+    program.add_argument('--worker-listen', help='run as a worker node listening on this address', dest='worker_listen', metavar='HOST:PORT')
+    program.add_argument('--worker-authkey', help='shared secret between coordinator and worker nodes', dest='worker_authkey')
+    program.add_argument('--stream-input', help='process a live stream from a pipe (-), v4l2 device or file standing in for one', dest='stream_input')
+    program.add_argument('--stream-output', help='pipe (-), v4l2 device, url or file receiving the processed stream', dest='stream_output', default='-')
+    program.add_argument('--stream-resolution', help='resolution the stream is scaled to', dest='stream_resolution', metavar='WIDTHxHEIGHT')
+    program.add_argument('--stream-fps', help='target fps of the stream', dest='stream_fps', type=float)
+    program.add_argument('--stream-latency-budget', help='per-frame processing budget in milliseconds, defaults to the frame interval', dest='stream_latency_budget', type=float)
+    program.add_argument('--stream-loop', help='loop a file stream input', dest='stream_loop', action='store_true')
     program.add_argument('-v', '--version', action='version', version=f'{roop.metadata.name} {roop.metadata.version}')
 
     args = program.parse_args()
+    if (args.worker_addresses or args.worker_listen) and not args.worker_authkey:
+        program.error('--workers and --worker-listen require --worker-authkey')
     # 设置参数
+    roop.globals.face_map = [{'source': source_path, 'reference': reference_path} for source_path, reference_path in args.face_map]
+    if args.face_map_path:
+        try:
+            roop.globals.face_map.extend(load_face_map(args.face_map_path))
+        except (OSError, ValueError) as exception:
+            program.error(f'invalid face map file: {exception}')
     roop.globals.source_path = args.source_path
+    # 只给出映射时，以第一张源图作为源文件
+    if not roop.globals.source_path and roop.globals.face_map:
+        roop.globals.source_path = roop.globals.face_map[0]['source']
     roop.globals.target_path = args.target_path
     roop.globals.output_path = normalize_output_path(roop.globals.source_path, roop.globals.target_path, args.output_path)  # type: ignore
-    roop.globals.headless = roop.globals.source_path and roop.globals.target_path and roop.globals.output_path
+    roop.globals.headless = (roop.globals.source_path and roop.globals.target_path and roop.globals.output_path) or args.stream_input
     roop.globals.frame_processors = args.frame_processor
     roop.globals.keep_fps = args.keep_fps
     roop.globals.keep_frames = args.keep_frames
@@ -68,13 +115,40 @@ def parse_args() -> None:
     roop.globals.reference_face_position = args.reference_face_position
     roop.globals.reference_frame_number = args.reference_frame_number
     roop.globals.similar_face_distance = args.similar_face_distance
+    roop.globals.trim_frame_start = args.trim_frame_start
+    roop.globals.trim_frame_end = args.trim_frame_end
     roop.globals.temp_frame_format = args.temp_frame_format
     roop.globals.temp_frame_quality = args.temp_frame_quality
+    roop.globals.temp_directory = args.temp_directory
+    roop.globals.keyframe_interval = args.keyframe_interval
+    roop.globals.keyframe_motion_threshold = args.keyframe_motion_threshold
+    roop.globals.face_index = args.face_index
+    roop.globals.cache_directory = args.cache_directory
+    roop.globals.output_cache = args.output_cache
+    roop.globals.output_cache_size = args.output_cache_size
+    roop.globals.model_mirror = args.model_mirror
     roop.globals.output_video_encoder = args.output_video_encoder
     roop.globals.output_video_quality = args.output_video_quality
     roop.globals.max_memory = args.max_memory
     roop.globals.execution_providers = decode_execution_providers(args.execution_provider)
     roop.globals.execution_threads = args.execution_threads
+    roop.globals.execution_profile = args.execution_profile
+    roop.globals.model_variant = args.model_variant
+    roop.globals.face_enhancer_runtime = args.face_enhancer_runtime
+    roop.globals.face_enhancer_min_size = args.face_enhancer_min_size
+    roop.globals.face_enhancer_max_size = args.face_enhancer_max_size
+    roop.globals.frame_prefetch_depth = args.frame_prefetch_depth
+    roop.globals.frame_write_depth = args.frame_write_depth
+    roop.globals.worker_addresses = args.worker_addresses
+    roop.globals.local_workers = args.local_workers
+    roop.globals.worker_listen = args.worker_listen
+    roop.globals.worker_authkey = args.worker_authkey
+    roop.globals.stream_input = args.stream_input
+    roop.globals.stream_output = args.stream_output
+    roop.globals.stream_resolution = args.stream_resolution
+    roop.globals.stream_fps = args.stream_fps
+    roop.globals.stream_latency_budget = args.stream_latency_budget
+    roop.globals.stream_loop = args.stream_loop
 
 
 """
@@ -103,12 +177,6 @@ def suggest_execution_threads() -> int:
 
 
 def limit_resources() -> None:
-    # prevent tensorflow memory leak
-    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
-    for gpu in gpus:
-        tensorflow.config.experimental.set_virtual_device_configuration(gpu, [
-            tensorflow.config.experimental.VirtualDeviceConfiguration(memory_limit=1024)
-        ])
     # limit memory usage
     if roop.globals.max_memory:
         memory = roop.globals.max_memory * 1024 ** 3
@@ -148,9 +216,22 @@ def update_status(message: str, scope: str = 'ROOP.CORE') -> None:
     开始按钮
 """
 def start() -> None:
+    clear_ffmpeg()
+    # identical jobs reuse the cached output before any model is loaded
+    output_cache_key = None
+    if roop.globals.output_cache and not is_batch_target(roop.globals.target_path) and has_output_cache_inputs(roop.globals.source_path, roop.globals.target_path):
+        output_cache_key = get_output_cache_key(roop.globals.source_path, roop.globals.target_path)
+        if restore_cached_output(output_cache_key, roop.globals.output_path):
+            update_status(f'Output cache hit {output_cache_key[:16]}, restored {roop.globals.output_path}')
+            return
+        update_status(f'Output cache miss {output_cache_key[:16]}, processing...')
     for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
         if not frame_processor.pre_start():
             return
+    # process image directory or glob
+    if is_batch_target(roop.globals.target_path):
+        start_batch()
+        return
     # process image to image
     if has_image_extension(roop.globals.target_path):
         if predict_image(roop.globals.target_path):
@@ -161,64 +242,154 @@ def start() -> None:
             update_status('Progressing...', frame_processor.NAME)
             frame_processor.process_image(roop.globals.source_path, roop.globals.output_path, roop.globals.output_path)
             frame_processor.post_process()
+        clear_swapped_faces()
         # validate image
         if is_image(roop.globals.target_path):
             update_status('Processing to image succeed!')
+            store_output_cache(output_cache_key)
         else:
             update_status('Processing to image failed!')
         return
     # process image to videos
     if predict_video(roop.globals.target_path):
         destroy()
+    # shard frame ranges across worker nodes
+    if roop.globals.worker_addresses or roop.globals.local_workers:
+        if roop.globals.trim_frame_start or roop.globals.trim_frame_end:
+            update_status('Trimming is not supported with workers, processing the whole video...')
+        update_status('Processing with workers...')
+        if process_distributed(roop.globals.source_path, roop.globals.target_path, roop.globals.output_path):
+            update_status('Processing to video succeed!')
+            store_output_cache(output_cache_key)
+        else:
+            update_status('Processing to video failed!')
+        return
     update_status('Creating temporary resources...')
+    # trimmed segments are spliced back into the original stream and therefore keep the target fps
+    trim_video = bool(roop.globals.trim_frame_start or roop.globals.trim_frame_end)
+    keep_fps = roop.globals.keep_fps or trim_video
+    fps = detect_fps(roop.globals.target_path) if keep_fps else 30
+    trim_range = get_trim_range(roop.globals.target_path, fps) if trim_video else None
+    # check the space before extraction instead of failing midway
+    if not select_temp_directory(roop.globals.target_path, fps, trim_range):
+        update_status('Not enough free space for temporary frames...')
+        return
     create_temp(roop.globals.target_path)
     # extract frames
-    if roop.globals.keep_fps:
-        fps = detect_fps(roop.globals.target_path)
-        update_status(f'Extracting frames with {fps} FPS...')
+    if trim_range:
+        start_time, end_time = trim_range
+        update_status(f'Extracting frames from {start_time}s to {end_time or "end"}s with {fps} FPS to {get_temp_directory_path(roop.globals.target_path)}...')
+        extract_frames(roop.globals.target_path, fps, trim_range)
+    elif keep_fps:
+        update_status(f'Extracting frames with {fps} FPS to {get_temp_directory_path(roop.globals.target_path)}...')
         extract_frames(roop.globals.target_path, fps)
     else:
-        update_status('Extracting frames with 30 FPS...')
+        update_status(f'Extracting frames with 30 FPS to {get_temp_directory_path(roop.globals.target_path)}...')
         extract_frames(roop.globals.target_path)
     # process frame
     temp_frame_paths = get_temp_frame_paths(roop.globals.target_path)
+    if trim_range:
+        temp_frame_paths = get_trim_frame_paths(temp_frame_paths, fps, trim_range[0])
     if temp_frame_paths:
+        # detections of the target are shared by every processor and every later run
+        if roop.globals.face_index:
+            update_status(f'Loaded face index with {prepare_face_index(roop.globals.target_path, fps, trim_range)} frames...')
         for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
             update_status('Progressing...', frame_processor.NAME)
             frame_processor.process_video(roop.globals.source_path, temp_frame_paths)
             frame_processor.post_process()
+        save_face_index()
+        clear_face_index()
+        clear_swapped_faces()
     else:
         update_status('Frames not found...')
         return
-    # create video
-    if roop.globals.keep_fps:
-        fps = detect_fps(roop.globals.target_path)
-        update_status(f'Creating video with {fps} FPS...')
-        create_video(roop.globals.target_path, fps)
-    else:
-        update_status('Creating video with 30 FPS...')
-        create_video(roop.globals.target_path)
-    # handle audio
+    # create video, muxing the target audio during encode when there is any
+    mux_audio = not roop.globals.skip_audio and get_video_metadata(roop.globals.target_path).has_audio
     if roop.globals.skip_audio:
-        move_temp(roop.globals.target_path, roop.globals.output_path)
         update_status('Skipping audio...')
+    elif mux_audio and not keep_fps:
+        update_status('Restoring audio might cause issues as fps are not kept...')
+    # trimmed segments get their audio when spliced
+    encode_audio = mux_audio and not trim_range
+    if keep_fps:
+        update_status(f'Creating video with {fps} FPS...')
     else:
-        if roop.globals.keep_fps:
-            update_status('Restoring audio...')
-        else:
-            update_status('Restoring audio might cause issues as fps are not kept...')
-        restore_audio(roop.globals.target_path, roop.globals.output_path)
+        update_status('Creating video with 30 FPS...')
+    # a trimmed segment keeps the target time base so its head and tail can be stream copied
+    time_base = get_video_metadata(roop.globals.target_path).time_base if trim_range else None
+    if not create_video(roop.globals.target_path, fps, encode_audio, time_base) and encode_audio:
+        update_status('Creating video with audio failed, retrying without audio...')
+        create_video(roop.globals.target_path, fps, time_base=time_base)
+    # splice the processed segment back into the original stream
+    if trim_range:
+        update_status('Splicing video...')
+        if not splice_video(roop.globals.target_path, *trim_range, mux_audio):
+            update_status('Splicing video failed...')
+            return
+    move_temp(roop.globals.target_path, roop.globals.output_path)
     # clean temp
     update_status('Cleaning temporary resources...')
     clean_temp(roop.globals.target_path)
+    # report ffmpeg stage timings
+    update_status('FFmpeg stages: ' + ', '.join(f'{ffmpeg_result.stage} {ffmpeg_result.elapsed:.1f}s' for ffmpeg_result in get_ffmpeg_results()))
     # validate video
     if is_video(roop.globals.target_path):
         update_status('Processing to video succeed!')
+        store_output_cache(output_cache_key)
     else:
         update_status('Processing to video failed!')
 
 
+"""
+    处理成功后把输出存入缓存
+"""
+def store_output_cache(output_cache_key: Optional[str]) -> None:
+    if output_cache_key and os.path.isfile(roop.globals.output_path):
+        store_cached_output(output_cache_key, roop.globals.output_path)
+        output_cache_stats = get_output_cache_stats()
+        update_status(f'Output cache stored {output_cache_key[:16]}, {output_cache_stats["output_total"]} outputs using {output_cache_stats["cache_size"] / 1024 ** 2:.1f} MB')
+
+
+"""
+    批量处理目录或通配符中的图片，模型只加载一次
+"""
+def start_batch() -> None:
+    target_paths = []
+    for target_path in get_batch_target_paths(roop.globals.target_path):
+        if predict_image(target_path):
+            update_status(f'Skipping {target_path}...')
+        else:
+            target_paths.append(target_path)
+    os.makedirs(roop.globals.output_path, exist_ok=True)
+    output_paths = [normalize_output_path(roop.globals.source_path, target_path, roop.globals.output_path) for target_path in target_paths]
+    # the first processor reads the targets, the others process the outputs in place
+    source_paths = target_paths
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        update_status('Progressing...', frame_processor.NAME)
+        frame_processor.process_images(roop.globals.source_path, source_paths, output_paths)
+        frame_processor.post_process()
+        source_paths = output_paths
+    clear_swapped_faces()
+    # validate images
+    image_total = sum(is_image(output_path) for output_path in output_paths)
+    update_status(f'Processing to {image_total} of {len(target_paths)} images succeed!')
+
+
+"""
+    实时流处理，源人脸检查沿用换脸器，目标来自流本身
+"""
+def start_stream() -> None:
+    if not is_image(roop.globals.source_path) or not get_one_face(cv2.imread(roop.globals.source_path)):
+        update_status('Select an image with a face for source path.')
+        return
+    update_status('Processing stream...')
+    if not process_stream(roop.globals.source_path):
+        update_status('Processing stream failed!')
+
+
 def destroy() -> None:
+    cancel_ffmpeg()
     if roop.globals.target_path:
         clean_temp(roop.globals.target_path)
     sys.exit()
@@ -226,12 +397,27 @@ def destroy() -> None:
 
 def run() -> None:
     parse_args()
+    # 流输出到标准输出时，其余所有输出改到 stderr，避免混入 mpegts
+    if roop.globals.stream_input:
+        redirect_stream_stdout()
     if not pre_check():
         return
-    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-        if not frame_processor.pre_check():
-            return
+    # 各处理器的模型并发下载，失败在主线程汇报；此时界面尚未创建，只输出到控制台
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+    with ThreadPoolExecutor() as executor:
+        pre_checks = list(executor.map(lambda frame_processor: frame_processor.pre_check(), frame_processors))
+    for frame_processor, pre_check_passed in zip(frame_processors, pre_checks):
+        if not pre_check_passed:
+            print(f'[{frame_processor.NAME}] Downloading model failed or its checksum did not match.')
+    if not all(pre_checks):
+        return
     limit_resources()
+    if roop.globals.worker_listen:
+        serve_worker(roop.globals.worker_listen)
+        return
+    if roop.globals.stream_input:
+        start_stream()
+        return
     if roop.globals.headless:
         start()
     else:
@@ -0,0 +1,336 @@
+import math
+import multiprocessing
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+from multiprocessing.connection import Client, Connection, Listener
+from queue import Empty, Queue
+from typing import Any, Dict, List, Set, Tuple
+from tqdm import tqdm
+
+import roop.globals
+from roop.capturer import get_video_frame
+from roop.face_analyser import get_one_face
+from roop.face_index import get_content_hash, prepare_face_index, save_face_index, clear_face_index
+from roop.face_reference import set_face_reference, set_face_map
+from roop.processors.frame.core import load_frame_processor_module, clear_swapped_faces
+from roop.utilities import detect_fps, estimate_frame_total, get_video_metadata, extract_frame_range, get_temp_frame_paths, create_video, concat_video, get_temp_output_path, get_temp_directory_path, create_temp, move_temp, clean_temp
+
+NAME = 'ROOP.DISTRIBUTED'
+# 每个工作节点分到的片段数，片段多一些便于快慢节点之间均衡
+SEGMENTS_PER_WORKER = 4
+MIN_SEGMENT_FRAMES = 30
+SEGMENT_ATTEMPTS = 2
+TRANSFER_CHUNK_SIZE = 16 * 1024 * 1024
+# 随任务下发的选项，执行器等与节点硬件相关的选项由工作节点自己决定
+WORKER_OPTIONS = [
+    'frame_processors',
+    'keep_fps',
+    'many_faces',
+    'reference_face_position',
+    'reference_frame_number',
+    'similar_face_distance',
+    'face_map',
+    'temp_frame_format',
+    'temp_frame_quality',
+    'output_video_encoder',
+    'output_video_quality',
+    'face_index',
+    'model_variant',
+    'face_enhancer_min_size',
+    'face_enhancer_max_size',
+    'keyframe_interval',
+    'keyframe_motion_threshold'
+]
+# 本地工作进程沿用本机的执行设置
+LOCAL_WORKER_OPTIONS = WORKER_OPTIONS + [
+    'execution_providers',
+    'execution_threads',
+    'execution_profile',
+    'face_enhancer_runtime',
+    'frame_prefetch_depth',
+    'frame_write_depth',
+    'cache_directory',
+    'model_mirror',
+    'log_level'
+]
+# 工作节点上已经完成预检查的处理器
+PRE_CHECKED_FRAME_PROCESSORS: Set[str] = set()
+
+
+def parse_worker_address(worker_address: str) -> Tuple[str, int]:
+    host, _, port = worker_address.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def get_worker_options(option_names: List[str]) -> Dict[str, Any]:
+    return {option_name: getattr(roop.globals, option_name) for option_name in option_names}
+
+
+def apply_worker_options(worker_options: Dict[str, Any]) -> None:
+    for option_name, option_value in worker_options.items():
+        setattr(roop.globals, option_name, option_value)
+
+
+"""
+    按帧号把视频切成若干片段，返回 (起始帧, 结束帧) 列表，结束帧不含在片段内
+"""
+def create_segments(frame_total: int, worker_total: int) -> List[Tuple[int, int]]:
+    segment_frame_total = max(math.ceil(frame_total / max(worker_total * SEGMENTS_PER_WORKER, 1)), MIN_SEGMENT_FRAMES)
+    return [(start_frame, min(start_frame + segment_frame_total, frame_total)) for start_frame in range(0, frame_total, segment_frame_total)]
+
+
+"""
+    协调节点：把目标视频按帧号切片分发给工作节点，各节点使用同一张源人脸与参考人脸，
+    收回编码好的片段后无损拼接并恢复音频
+"""
+def process_distributed(source_path: str, target_path: str, output_path: str) -> bool:
+    connections = connect_workers()
+    if not connections:
+        print(f'[{NAME}] No worker available.')
+        return False
+    fps = detect_fps(target_path) if roop.globals.keep_fps else 30
+    segments = create_segments(estimate_frame_total(target_path, fps), len(connections))
+    if not segments:
+        return False
+    # 参考人脸与多人映射在完整视频上解析一次，避免各片段各自选出不同的人
+    reference_face = None
+    face_map = []
+    if 'face_swapper' in roop.globals.frame_processors:
+        reference_face = get_one_face(get_video_frame(target_path, roop.globals.reference_frame_number), roop.globals.reference_face_position)
+        if roop.globals.face_map:
+            face_map = load_frame_processor_module('face_swapper').create_face_map(lambda frame_number: get_video_frame(target_path, frame_number))
+    with open(source_path, 'rb') as source_file:
+        job = {
+            'source_data': source_file.read(),
+            'source_extension': os.path.splitext(source_path)[1],
+            'reference_face': reference_face,
+            'face_map': face_map,
+            'fps': fps,
+            'options': get_worker_options(WORKER_OPTIONS)
+        }
+    # 工作节点按内容哈希确认本地的同名文件就是目标，并用它作为人脸索引的键
+    target_hash = get_content_hash(target_path)
+    create_temp(target_path)
+    segment_queue: Queue[int] = Queue()
+    for segment_number in range(len(segments)):
+        segment_queue.put(segment_number)
+    segment_paths: Dict[int, str] = {}
+    failed_segments: Set[int] = set()
+    segment_attempts: Dict[int, int] = {}
+    thread_lock = threading.Lock()
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+
+    def is_finished() -> bool:
+        return len(segment_paths) + len(failed_segments) == len(segments)
+
+    def dispatch_segments(connection: Connection, progress: Any) -> None:
+        try:
+            send_target(connection, target_path, target_hash)
+            while not is_finished():
+                try:
+                    segment_number = segment_queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                start_frame, end_frame = segments[segment_number]
+                try:
+                    connection.send(('segment', dict(job, segment_number=segment_number, start_frame=start_frame, end_frame=end_frame)))
+                    status, message = connection.recv()
+                    segment_data = connection.recv_bytes() if status == 'segment' else None
+                except (EOFError, OSError):
+                    # 节点掉线，片段交给其他节点
+                    segment_queue.put(segment_number)
+                    raise
+                with thread_lock:
+                    if segment_data is not None:
+                        segment_path = os.path.join(get_temp_directory_path(target_path), f'segment-{segment_number:04d}.mp4')
+                        with open(segment_path, 'wb') as segment_file:
+                            segment_file.write(segment_data)
+                        segment_paths[segment_number] = segment_path
+                        progress.update(end_frame - start_frame)
+                        continue
+                    print(f'[{NAME}] Segment {segment_number} failed: {message}')
+                    segment_attempts[segment_number] = segment_attempts.get(segment_number, 0) + 1
+                    if segment_attempts[segment_number] < SEGMENT_ATTEMPTS:
+                        segment_queue.put(segment_number)
+                    else:
+                        failed_segments.add(segment_number)
+        except (EOFError, OSError) as exception:
+            print(f'[{NAME}] Worker disconnected: {exception}')
+        finally:
+            connection.close()
+
+    with tqdm(total=segments[-1][1], desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        threads = [threading.Thread(target=dispatch_segments, args=(connection, progress)) for connection in connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if len(segment_paths) < len(segments):
+        print(f'[{NAME}] {len(segments) - len(segment_paths)} of {len(segments)} segments were not processed.')
+        clean_temp(target_path)
+        return False
+    mux_audio = not roop.globals.skip_audio and get_video_metadata(target_path).has_audio
+    if not concat_video(target_path, [segment_paths[segment_number] for segment_number in sorted(segment_paths)], mux_audio):
+        clean_temp(target_path)
+        return False
+    move_temp(target_path, output_path)
+    clean_temp(target_path)
+    return True
+
+
+"""
+    连接远程工作节点，并按需启动本地工作进程
+"""
+def connect_workers() -> List[Connection]:
+    connections = []
+    for worker_address in roop.globals.worker_addresses:
+        try:
+            connections.append(Client(parse_worker_address(worker_address), authkey=roop.globals.worker_authkey.encode()))
+        except (OSError, multiprocessing.AuthenticationError) as exception:
+            print(f'[{NAME}] Cannot connect to worker {worker_address}: {exception}')
+    if roop.globals.local_workers:
+        connections.extend(start_local_workers(roop.globals.local_workers))
+    return connections
+
+
+"""
+    启动本地工作进程代替远程节点，使用 spawn 避免继承已初始化的 GPU 上下文
+"""
+def start_local_workers(worker_total: int) -> List[Connection]:
+    context = multiprocessing.get_context('spawn')
+    authkey = secrets.token_bytes(16)
+    worker_options = get_worker_options(LOCAL_WORKER_OPTIONS)
+    connections = []
+    for _ in range(worker_total):
+        address_reader, address_writer = context.Pipe(duplex=False)
+        context.Process(target=run_local_worker, args=(worker_options, authkey, address_writer), daemon=True).start()
+        connections.append(Client(address_reader.recv(), authkey=authkey))
+    return connections
+
+
+def run_local_worker(worker_options: Dict[str, Any], authkey: bytes, address_writer: Connection) -> None:
+    apply_worker_options(worker_options)
+    # 工作进程没有界面，状态只输出到终端
+    roop.globals.headless = True
+    with Listener(('127.0.0.1', 0), authkey=authkey) as listener:
+        address_writer.send(listener.address)
+        with listener.accept() as connection:
+            handle_coordinator(connection)
+
+
+"""
+    工作节点：在指定地址监听，依次服务每个协调节点
+"""
+def serve_worker(worker_address: str) -> None:
+    roop.globals.headless = True
+    with Listener(parse_worker_address(worker_address), authkey=roop.globals.worker_authkey.encode()) as listener:
+        print(f'[{NAME}] Worker listening on {worker_address}')
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, multiprocessing.AuthenticationError) as exception:
+                print(f'[{NAME}] Rejected coordinator: {exception}')
+                continue
+            with connection:
+                handle_coordinator(connection)
+
+
+"""
+    目标文件：节点能直接访问同一路径（共享存储、本地进程）且内容哈希一致时直接使用，否则由协调节点传输
+"""
+def send_target(connection: Connection, target_path: str, target_hash: str) -> None:
+    connection.send(('target', os.path.abspath(target_path), os.path.getsize(target_path), target_hash))
+    if connection.recv() == 'send_target':
+        with open(target_path, 'rb') as target_file:
+            for chunk in iter(lambda: target_file.read(TRANSFER_CHUNK_SIZE), b''):
+                connection.send_bytes(chunk)
+        connection.send_bytes(b'')
+        connection.recv()
+
+
+def receive_target(connection: Connection, target_path: str, target_size: int, target_hash: str, work_directory: str) -> str:
+    # 先比较大小，不同时无需读取整个文件
+    if os.path.isfile(target_path) and os.path.getsize(target_path) == target_size and get_content_hash(target_path) == target_hash:
+        connection.send('ready')
+        return target_path
+    connection.send('send_target')
+    received_target_path = os.path.join(work_directory, 'target' + os.path.splitext(target_path)[1])
+    with open(received_target_path, 'wb') as target_file:
+        for chunk in iter(connection.recv_bytes, b''):
+            target_file.write(chunk)
+    connection.send('ready')
+    return received_target_path
+
+
+def handle_coordinator(connection: Connection) -> None:
+    work_directory = tempfile.mkdtemp(prefix='roop-worker-')
+    target_path = None
+    target_hash = None
+    try:
+        while True:
+            try:
+                kind, *message = connection.recv()
+            except EOFError:
+                break
+            if kind == 'target':
+                remote_target_path, target_size, target_hash = message
+                target_path = receive_target(connection, remote_target_path, target_size, target_hash, work_directory)
+            if kind == 'segment':
+                if not target_path or not target_hash:
+                    connection.send(('error', 'no target received'))
+                    continue
+                try:
+                    segment_data = process_segment(target_path, target_hash, message[0], work_directory)
+                except Exception as exception:
+                    connection.send(('error', str(exception)))
+                    continue
+                connection.send(('segment', None))
+                connection.send_bytes(segment_data)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+"""
+    处理一个片段：提取该帧号区间的帧，沿用协调节点的参考人脸处理后编码为独立片段（不含音频）
+"""
+def process_segment(target_path: str, target_hash: str, job: Dict[str, Any], work_directory: str) -> bytes:
+    apply_worker_options(job['options'])
+    # 每个片段使用独立的文件名，临时目录互不冲突
+    segment_path = os.path.join(work_directory, f'segment-{job["segment_number"]:04d}' + os.path.splitext(target_path)[1])
+    os.symlink(os.path.abspath(target_path), segment_path)
+    source_path = os.path.join(work_directory, 'source' + job['source_extension'])
+    with open(source_path, 'wb') as source_file:
+        source_file.write(job['source_data'])
+    roop.globals.source_path = source_path
+    roop.globals.target_path = segment_path
+    set_face_reference(job['reference_face'])
+    set_face_map(job['face_map'])
+    fps = job['fps']
+    trim_range = (job['start_frame'] / fps, job['end_frame'] / fps)
+    create_temp(segment_path)
+    try:
+        if not extract_frame_range(segment_path, fps, job['start_frame'], job['end_frame']):
+            raise RuntimeError('extracting frames failed')
+        temp_frame_paths = get_temp_frame_paths(segment_path)
+        if roop.globals.face_index:
+            prepare_face_index(segment_path, fps, trim_range, target_hash)
+        for frame_processor_name in roop.globals.frame_processors:
+            frame_processor = load_frame_processor_module(frame_processor_name)
+            if frame_processor_name not in PRE_CHECKED_FRAME_PROCESSORS:
+                if not frame_processor.pre_check():
+                    raise RuntimeError(f'{frame_processor.NAME} pre check failed')
+                PRE_CHECKED_FRAME_PROCESSORS.add(frame_processor_name)
+            frame_processor.process_video(source_path, temp_frame_paths)
+        save_face_index()
+        clear_face_index()
+        clear_swapped_faces()
+        if not create_video(segment_path, fps):
+            raise RuntimeError('creating the segment failed')
+        with open(get_temp_output_path(segment_path), 'rb') as segment_file:
+            return segment_file.read()
+    finally:
+        clean_temp(segment_path)
+        os.remove(segment_path)
@@ -0,0 +1,211 @@
+import json
+import os
+import platform
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import numpy
+import onnx
+import onnxruntime
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from onnxruntime.transformers.float16 import convert_float_to_float16
+
+import roop.globals
+from roop.utilities import resolve_relative_path
+
+EXECUTION_PROFILES = ['default', 'latency', 'throughput', 'low-memory', 'auto']
+EXECUTION_PROFILE_CACHE_PATH = resolve_relative_path('../models/execution-profiles.json')
+MODEL_VARIANTS = ['fp32', 'optimized', 'int8', 'fp16']
+MODEL_VARIANT_CACHE_PATH = resolve_relative_path('../models/model-variants.json')
+CALIBRATION_RUNS = 8
+THREAD_LOCK = threading.Lock()
+
+
+"""
+    按执行配置创建 onnxruntime 的 SessionOptions，default 保持 onnxruntime 的默认值
+"""
+def create_session_options(model_path: str) -> onnxruntime.SessionOptions:
+    if roop.globals.execution_profile == 'auto':
+        session_config = get_calibrated_session_config(model_path)
+    else:
+        session_config = get_session_config(roop.globals.execution_profile)
+    return apply_session_config(onnxruntime.SessionOptions(), session_config)
+
+
+"""
+    各执行配置对应的参数：
+    latency 单次推理使用所有核心，适合预览与实时处理
+    throughput 按执行线程数平分核心，避免与 --execution-threads 争抢
+    low-memory 关闭内存池与内存复用规划，降低常驻内存
+"""
+def get_session_config(execution_profile: str) -> Dict[str, Any]:
+    cpu_total = os.cpu_count() or 1
+    thread_total = max(cpu_total // max(roop.globals.execution_threads or 1, 1), 1)
+    if execution_profile == 'latency':
+        return {'intra_op_num_threads': cpu_total, 'inter_op_num_threads': 1, 'execution_mode': 'sequential', 'graph_optimization_level': 'all'}
+    if execution_profile == 'throughput':
+        return {'intra_op_num_threads': thread_total, 'inter_op_num_threads': 1, 'execution_mode': 'sequential', 'graph_optimization_level': 'all'}
+    if execution_profile == 'low-memory':
+        return {'intra_op_num_threads': thread_total, 'inter_op_num_threads': 1, 'execution_mode': 'sequential', 'graph_optimization_level': 'basic', 'enable_cpu_mem_arena': False, 'enable_mem_pattern': False}
+    return {}
+
+
+def apply_session_config(session_options: onnxruntime.SessionOptions, session_config: Dict[str, Any]) -> onnxruntime.SessionOptions:
+    graph_optimization_levels = {
+        'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    }
+    execution_modes = {
+        'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+        'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL
+    }
+    if 'intra_op_num_threads' in session_config:
+        session_options.intra_op_num_threads = session_config['intra_op_num_threads']
+    if 'inter_op_num_threads' in session_config:
+        session_options.inter_op_num_threads = session_config['inter_op_num_threads']
+    if 'execution_mode' in session_config:
+        session_options.execution_mode = execution_modes[session_config['execution_mode']]
+    if 'graph_optimization_level' in session_config:
+        session_options.graph_optimization_level = graph_optimization_levels[session_config['graph_optimization_level']]
+    if 'enable_cpu_mem_arena' in session_config:
+        session_options.enable_cpu_mem_arena = session_config['enable_cpu_mem_arena']
+    if 'enable_mem_pattern' in session_config:
+        session_options.enable_mem_pattern = session_config['enable_mem_pattern']
+    return session_options
+
+
+"""
+    自动调优：在本机上对模型做一次简短的校准，按执行线程并发测量各配置的吞吐，结果按主机缓存
+"""
+def get_calibrated_session_config(model_path: str) -> Dict[str, Any]:
+    with THREAD_LOCK:
+        execution_profile_key = get_execution_profile_key(model_path)
+        execution_profile_cache = load_json_cache(EXECUTION_PROFILE_CACHE_PATH)
+        if execution_profile_key not in execution_profile_cache:
+            execution_profile_cache[execution_profile_key] = calibrate_session_config(model_path)
+            save_json_cache(EXECUTION_PROFILE_CACHE_PATH, execution_profile_cache)
+    return execution_profile_cache[execution_profile_key]
+
+
+def get_execution_profile_key(model_path: str) -> str:
+    return '|'.join([
+        platform.node(),
+        platform.processor() or platform.machine(),
+        str(os.cpu_count()),
+        ','.join(roop.globals.execution_providers),
+        str(roop.globals.execution_threads),
+        os.path.basename(model_path)
+    ])
+
+
+def calibrate_session_config(model_path: str) -> Dict[str, Any]:
+    best_session_config: Dict[str, Any] = {}
+    best_frame_rate = 0.0
+    for session_config in get_calibration_session_configs():
+        session_options = apply_session_config(onnxruntime.SessionOptions(), session_config)
+        session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=roop.globals.execution_providers)
+        session_inputs = create_calibration_inputs(session)
+        # 预热
+        session.run(None, session_inputs)
+        execution_threads = max(roop.globals.execution_threads or 1, 1)
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=execution_threads) as executor:
+            for _ in executor.map(lambda _: session.run(None, session_inputs), range(CALIBRATION_RUNS * execution_threads)):
+                pass
+        frame_rate = CALIBRATION_RUNS * execution_threads / (time.perf_counter() - start_time)
+        if frame_rate > best_frame_rate:
+            best_frame_rate = frame_rate
+            best_session_config = session_config
+    return best_session_config
+
+
+def get_calibration_session_configs() -> List[Dict[str, Any]]:
+    cpu_total = os.cpu_count() or 1
+    session_configs = [get_session_config('default')]
+    intra_op_num_threads = 1
+    while intra_op_num_threads <= cpu_total:
+        session_configs.append({'intra_op_num_threads': intra_op_num_threads, 'inter_op_num_threads': 1, 'execution_mode': 'sequential', 'graph_optimization_level': 'all'})
+        intra_op_num_threads *= 2
+    return session_configs
+
+
+"""
+    按模型输入生成随机数据，动态维度批量取 1，空间尺寸取 640
+"""
+def create_calibration_inputs(session: onnxruntime.InferenceSession) -> Dict[str, Any]:
+    session_inputs = {}
+    for session_input in session.get_inputs():
+        shape = [dimension if isinstance(dimension, int) else (1 if index == 0 else 640) for index, dimension in enumerate(session_input.shape)]
+        session_inputs[session_input.name] = numpy.random.rand(*shape).astype(numpy.float32)
+    return session_inputs
+
+
+"""
+    模型变体路径，fp32 即原模型
+"""
+def get_model_variant_path(model_path: str) -> str:
+    if roop.globals.model_variant == 'fp32':
+        return model_path
+    model_name, model_extension = os.path.splitext(model_path)
+    return f'{model_name}.{roop.globals.model_variant}{model_extension}'
+
+
+"""
+    生成并缓存模型变体，已存在时直接复用：
+    optimized 为 onnxruntime 离线优化后的图，int8 为动态量化，fp16 保留 fp32 的输入输出
+"""
+def prepare_model_variant(model_path: str, variant_path: str) -> str:
+    if variant_path == model_path or os.path.isfile(variant_path):
+        return variant_path
+    os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+    # 先写入临时文件，避免中断后留下不完整的模型
+    temp_variant_path = variant_path + '.part'
+    if roop.globals.model_variant == 'optimized':
+        session_options = onnxruntime.SessionOptions()
+        # 离线保存时不做与硬件相关的布局优化
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        session_options.optimized_model_filepath = temp_variant_path
+        onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=['CPUExecutionProvider'])
+    if roop.globals.model_variant == 'int8':
+        quantize_dynamic(model_path, temp_variant_path, weight_type=QuantType.QUInt8)
+    if roop.globals.model_variant == 'fp16':
+        onnx.save(convert_float_to_float16(onnx.load(model_path), keep_io_types=True), temp_variant_path)
+    os.replace(temp_variant_path, variant_path)
+    return variant_path
+
+
+"""
+    模型变体与 fp32 基线的对比结果，按变体文件缓存
+"""
+def get_model_variant_report(variant_path: str) -> Optional[Dict[str, float]]:
+    model_variant_cache = load_json_cache(MODEL_VARIANT_CACHE_PATH)
+    model_variant_entry = model_variant_cache.get(variant_path)
+    if model_variant_entry and model_variant_entry['mtime'] == os.path.getmtime(variant_path):
+        return model_variant_entry['report']
+    return None
+
+
+def set_model_variant_report(variant_path: str, report: Dict[str, float]) -> None:
+    with THREAD_LOCK:
+        model_variant_cache = load_json_cache(MODEL_VARIANT_CACHE_PATH)
+        model_variant_cache[variant_path] = {'mtime': os.path.getmtime(variant_path), 'report': report}
+        save_json_cache(MODEL_VARIANT_CACHE_PATH, model_variant_cache)
+
+
+def load_json_cache(cache_path: str) -> Dict[str, Any]:
+    if os.path.isfile(cache_path):
+        with open(cache_path) as cache_file:
+            try:
+                return json.load(cache_file)
+            except ValueError:
+                pass
+    return {}
+
+
+def save_json_cache(cache_path: str, cache: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=4)
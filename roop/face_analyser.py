@@ -1,13 +1,21 @@
+import glob
+import os
 import threading
-from typing import Any, Optional, List
+from typing import Any, Optional, List, Tuple
 import insightface
 import numpy
+import onnxruntime
+from insightface.utils import face_align, ensure_available
 
 import roop.globals
+from roop.execution import create_session_options, prepare_model_variant
 from roop.typing import Frame, Face
+from roop.utilities import resolve_relative_path
 
 FACE_ANALYSER = None
 THREAD_LOCK = threading.Lock()
+# 每个线程记录上一帧匹配到的人脸框
+FACE_MATCH = threading.local()
 
 """
     获取人脸解析器
@@ -17,14 +25,42 @@ def get_face_analyser() -> Any:
     # 线程加锁
     with THREAD_LOCK:
         if FACE_ANALYSER is None:
+            model_directory = ensure_available('models', 'buffalo_l')
+            variant_directory = prepare_face_analyser_variant(model_directory)
             # https://insightface.ai/
             # 构建人脸分析器，param2 = 是执行器（GPU or CPU）
-            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.execution_providers)
+            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', root=os.path.dirname(os.path.dirname(model_directory)), providers=roop.globals.execution_providers)
+            create_model_sessions(FACE_ANALYSER, model_directory, variant_directory)
             # 猜测可能是 CUDD:0 执行器 ID
             FACE_ANALYSER.prepare(ctx_id=0)
     return FACE_ANALYSER
 
 
+"""
+    生成 buffalo_l 的模型变体，与原模型同名存放在 models/buffalo_l-<变体> 下
+"""
+def prepare_face_analyser_variant(model_directory: str) -> str:
+    if roop.globals.model_variant == 'fp32':
+        return model_directory
+    variant_directory = resolve_relative_path(f'../models/buffalo_l-{roop.globals.model_variant}')
+    for model_path in glob.glob(os.path.join(model_directory, '*.onnx')):
+        prepare_model_variant(model_path, os.path.join(variant_directory, os.path.basename(model_path)))
+    return variant_directory
+
+
+"""
+    insightface 只把执行器传给子模型，会话配置不会生效：每个子模型按执行配置重新创建变体的推理会话，
+    预处理参数从 fp32 模型读取
+"""
+def create_model_sessions(face_analyser: Any, model_directory: str, variant_directory: str) -> None:
+    for taskname, model in face_analyser.models.items():
+        model_name = os.path.basename(model.model_file)
+        variant_path = os.path.join(variant_directory, model_name)
+        session = onnxruntime.InferenceSession(variant_path, sess_options=create_session_options(variant_path), providers=roop.globals.execution_providers)
+        face_analyser.models[taskname] = type(model)(model_file=os.path.join(model_directory, model_name), session=session)
+    face_analyser.det_model = face_analyser.models['detection']
+
+
 """
     删除人脸解析器
 """
@@ -59,18 +95,131 @@ def get_many_faces(frame: Frame) -> Optional[List[Face]]:
 
 
 """
-    从图像中查找 相似的人脸
+    只做人脸检测，不计算识别特征等其他属性，det_size 为空时使用检测器的默认尺寸
 """
-def find_similar_face(frame: Frame, reference_face: Face) -> Optional[Face]:
-    # 从图像中解析所有人脸
-    many_faces = get_many_faces(frame)
-    if many_faces:
-        for face in many_faces:
-            # 解析人脸中的 normed_embedding， 做对比
-            if hasattr(face, 'normed_embedding') and hasattr(reference_face, 'normed_embedding'):
-                # 相减，平方，再相加，计算 距离
-                distance = numpy.sum(numpy.square(face.normed_embedding - reference_face.normed_embedding))
-                # 如果距离小于 配置文件中的阈值，就 表示相似
-                if distance < roop.globals.similar_face_distance:
-                    return face
+def detect_many_faces(frame: Frame, det_size: Optional[Tuple[int, int]] = None) -> List[Face]:
+    try:
+        bboxes, kpss = get_face_analyser().det_model.detect(frame, input_size=det_size, max_num=0, metric='default')
+    except ValueError:
+        return []
+    many_faces = []
+    for index in range(bboxes.shape[0]):
+        kps = kpss[index] if kpss is not None else None
+        many_faces.append(Face(bbox=bboxes[index, 0:4], kps=kps, det_score=bboxes[index, 4]))
+    return many_faces
+
+
+"""
+    为人脸补充指定模型的属性（识别特征、关键点、性别年龄等）
+"""
+def analyse_face(frame: Frame, face: Face, tasknames: List[str]) -> Face:
+    models = get_face_analyser().models
+    for taskname in tasknames:
+        if taskname in models:
+            models[taskname].get(frame, face)
+    return face
+
+
+"""
+    除检测与识别外的其余模型
+"""
+def get_attribute_tasknames() -> List[str]:
+    return [taskname for taskname in get_face_analyser().models if taskname not in ['detection', 'recognition']]
+
+
+"""
+    计算两个人脸框的交并比
+"""
+def calculate_bbox_overlap(bbox: Any, other_bbox: Any) -> float:
+    start_x = max(bbox[0], other_bbox[0])
+    start_y = max(bbox[1], other_bbox[1])
+    end_x = min(bbox[2], other_bbox[2])
+    end_y = min(bbox[3], other_bbox[3])
+    intersection = max(0, end_x - start_x) * max(0, end_y - start_y)
+    union = calculate_bbox_area(bbox) + calculate_bbox_area(other_bbox) - intersection
+    if union > 0:
+        return float(intersection / union)
+    return 0.0
+
+
+def calculate_bbox_area(bbox: Any) -> float:
+    return float(max(0, bbox[2] - bbox[0]) * max(0, bbox[3] - bbox[1]))
+
+
+"""
+    按廉价线索排序候选人脸：与上一帧匹配框的重叠度优先，其次是人脸大小
+"""
+def sort_face_candidates(many_faces: List[Face], previous_bbox: Any = None) -> List[Face]:
+    if previous_bbox is None:
+        return sorted(many_faces, key=lambda face: -calculate_bbox_area(face.bbox))
+    return sorted(many_faces, key=lambda face: (-calculate_bbox_overlap(face.bbox, previous_bbox), -calculate_bbox_area(face.bbox)))
+
+
+"""
+    计算两张人脸 normed_embedding 的距离
+"""
+def calculate_face_distance(face: Face, reference_face: Face) -> float:
+    # 相减，平方，再相加，计算 距离
+    return float(numpy.sum(numpy.square(face.normed_embedding - reference_face.normed_embedding)))
+
+
+"""
+    从图像中查找 相似的人脸，分阶段匹配：
+    先只做检测，按廉价线索排序候选人脸，再依次计算识别特征，确认匹配后立即停止；
+    传入 many_faces（如人脸索引中已带识别特征的人脸）时跳过检测与其余属性
+"""
+def find_similar_face(frame: Frame, reference_face: Face, many_faces: Optional[List[Face]] = None) -> Optional[Face]:
+    if reference_face is None or reference_face.normed_embedding is None:
+        return None
+    previous_bbox = getattr(FACE_MATCH, 'bbox', None)
+    for face in sort_face_candidates(detect_many_faces(frame) if many_faces is None else many_faces, previous_bbox):
+        # 只为当前候选人脸计算识别特征
+        if face.embedding is None:
+            analyse_face(frame, face, ['recognition'])
+        if face.normed_embedding is None:
+            continue
+        # 如果距离小于 配置文件中的阈值，就 表示相似
+        if calculate_face_distance(face, reference_face) < roop.globals.similar_face_distance:
+            FACE_MATCH.bbox = face.bbox
+            if many_faces is not None:
+                return face
+            # 只为确认匹配的人脸补全其余属性
+            return analyse_face(frame, face, get_attribute_tasknames())
     return None
+
+
+"""
+    批量计算多张人脸的识别特征，一次推理
+"""
+def embed_many_faces(frame: Frame, many_faces: List[Face]) -> None:
+    recognition_model = get_face_analyser().models['recognition']
+    crop_frames = [face_align.norm_crop(frame, landmark=face.kps, image_size=recognition_model.input_size[0]) for face in many_faces]
+    for face, embedding in zip(many_faces, recognition_model.get_feat(crop_frames)):
+        face.embedding = embedding
+
+
+"""
+    一次检测同时匹配多张参考人脸，返回与参考人脸一一对应的结果，未匹配到为 None；
+    传入 many_faces（如人脸索引中已带识别特征的人脸）时跳过检测与其余属性
+"""
+def find_similar_faces(frame: Frame, reference_faces: List[Face], many_faces: Optional[List[Face]] = None) -> List[Optional[Face]]:
+    similar_faces: List[Optional[Face]] = [None] * len(reference_faces)
+    analyse_attributes = many_faces is None
+    if many_faces is None:
+        many_faces = detect_many_faces(frame)
+        if many_faces and reference_faces:
+            embed_many_faces(frame, many_faces)
+    if many_faces and reference_faces:
+        face_embeddings = numpy.stack([face.normed_embedding for face in many_faces])
+        reference_embeddings = numpy.stack([reference_face.normed_embedding for reference_face in reference_faces])
+        # 距离矩阵，行是检测到的人脸，列是参考人脸
+        distances = numpy.sum(numpy.square(face_embeddings[:, numpy.newaxis] - reference_embeddings[numpy.newaxis]), axis=2)
+        matched_face_indices = set()
+        # 按距离从小到大贪心分配，每张人脸只对应一个参考人脸
+        for face_index, reference_index in zip(*numpy.unravel_index(numpy.argsort(distances, axis=None), distances.shape)):
+            if distances[face_index, reference_index] >= roop.globals.similar_face_distance:
+                break
+            if similar_faces[reference_index] is None and face_index not in matched_face_indices:
+                matched_face_indices.add(face_index)
+                similar_faces[reference_index] = analyse_face(frame, many_faces[face_index], get_attribute_tasknames()) if analyse_attributes else many_faces[face_index]
+    return similar_faces
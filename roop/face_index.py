@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import numpy
+
+import roop.globals
+from roop.face_analyser import get_face_analyser, detect_many_faces, embed_many_faces
+from roop.typing import Face, Frame
+
+# 帧号 -> (人脸框, 关键点, 检测分数, 识别特征)
+FACE_INDEX: Dict[int, Tuple[Any, Any, Any, Any]] = {}
+FACE_INDEX_PATH: Optional[str] = None
+# 本次运行是否新增了帧，有新增时才重新保存
+FACE_INDEX_CHANGED = False
+THREAD_LOCK = threading.Lock()
+CONTENT_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+"""
+    人脸索引文件路径，由目标文件内容哈希、检测器设置与抽帧设置共同决定；调用方已算出内容哈希时直接使用
+"""
+def get_face_index_path(target_path: str, fps: float, trim_range: Optional[Tuple[float, Optional[float]]] = None, content_hash: Optional[str] = None) -> str:
+    det_model = get_face_analyser().det_model
+    face_index_settings = {
+        'content_hash': content_hash or get_content_hash(target_path),
+        'model_variant': roop.globals.model_variant,
+        'det_size': list(det_model.input_size),
+        'det_thresh': det_model.det_thresh,
+        'fps': fps,
+        'trim_range': list(trim_range) if trim_range else None
+    }
+    face_index_key = hashlib.sha256(json.dumps(face_index_settings, sort_keys=True).encode()).hexdigest()
+    return os.path.join(roop.globals.cache_directory, 'face-index', face_index_key + '.npz')
+
+
+def get_content_hash(file_path: str) -> str:
+    content_hash = hashlib.blake2b()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CONTENT_HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+"""
+    加载目标视频的人脸索引，不存在时从空索引开始，处理过程中逐帧补全
+"""
+def prepare_face_index(target_path: str, fps: float, trim_range: Optional[Tuple[float, Optional[float]]] = None, content_hash: Optional[str] = None) -> int:
+    global FACE_INDEX_PATH, FACE_INDEX_CHANGED
+
+    FACE_INDEX_PATH = get_face_index_path(target_path, fps, trim_range, content_hash)
+    FACE_INDEX.clear()
+    FACE_INDEX_CHANGED = False
+    if os.path.isfile(FACE_INDEX_PATH):
+        FACE_INDEX.update(load_face_index(FACE_INDEX_PATH))
+    return len(FACE_INDEX)
+
+
+"""
+    列式读取：每帧一行记录帧号与人脸数，每张人脸一行记录框、关键点、分数与特征
+"""
+def load_face_index(face_index_path: str) -> Dict[int, Tuple[Any, Any, Any, Any]]:
+    face_index = {}
+    with numpy.load(face_index_path) as face_index_file:
+        face_offsets = numpy.concatenate([[0], numpy.cumsum(face_index_file['face_counts'])])
+        bboxes = face_index_file['bboxes']
+        kpss = face_index_file['kpss']
+        det_scores = face_index_file['det_scores']
+        embeddings = face_index_file['embeddings']
+        for frame_number, start, end in zip(face_index_file['frame_numbers'], face_offsets[:-1], face_offsets[1:]):
+            face_index[int(frame_number)] = (bboxes[start:end], kpss[start:end], det_scores[start:end], embeddings[start:end])
+    return face_index
+
+
+"""
+    有新增帧时写回索引文件，先写临时文件再替换
+"""
+def save_face_index() -> None:
+    global FACE_INDEX_CHANGED
+
+    if FACE_INDEX_PATH is None or not FACE_INDEX_CHANGED:
+        return
+    frame_numbers = sorted(FACE_INDEX)
+    frame_faces = [FACE_INDEX[frame_number] for frame_number in frame_numbers]
+    os.makedirs(os.path.dirname(FACE_INDEX_PATH), exist_ok=True)
+    with open(FACE_INDEX_PATH + '.part', 'wb') as face_index_file:
+        numpy.savez(
+            face_index_file,
+            frame_numbers=numpy.array(frame_numbers, dtype=numpy.int32),
+            face_counts=numpy.array([len(det_scores) for _, _, det_scores, _ in frame_faces], dtype=numpy.int32),
+            bboxes=numpy.concatenate([bboxes for bboxes, _, _, _ in frame_faces]).astype(numpy.float32),
+            kpss=numpy.concatenate([kpss for _, kpss, _, _ in frame_faces]).astype(numpy.float32),
+            det_scores=numpy.concatenate([det_scores for _, _, det_scores, _ in frame_faces]).astype(numpy.float32),
+            embeddings=numpy.concatenate([embeddings for _, _, _, embeddings in frame_faces]).astype(numpy.float32)
+        )
+    os.replace(FACE_INDEX_PATH + '.part', FACE_INDEX_PATH)
+    FACE_INDEX_CHANGED = False
+
+
+def clear_face_index() -> None:
+    global FACE_INDEX_PATH, FACE_INDEX_CHANGED
+
+    FACE_INDEX_PATH = None
+    FACE_INDEX.clear()
+    FACE_INDEX_CHANGED = False
+
+
+"""
+    读取一帧的人脸（只含框、关键点、分数与识别特征），未启用索引时返回 None；
+    索引中没有的帧现场检测并计算特征后补进索引
+"""
+def get_indexed_faces(frame_path: str, frame: Frame) -> Optional[List[Face]]:
+    global FACE_INDEX_CHANGED
+
+    if FACE_INDEX_PATH is None:
+        return None
+    frame_number = int(os.path.splitext(os.path.basename(frame_path))[0])
+    if frame_number not in FACE_INDEX:
+        many_faces = detect_many_faces(frame)
+        if many_faces:
+            embed_many_faces(frame, many_faces)
+        embedding_size = get_face_analyser().models['recognition'].output_shape[1]
+        with THREAD_LOCK:
+            FACE_INDEX[frame_number] = (
+                numpy.array([face.bbox for face in many_faces], dtype=numpy.float32).reshape(-1, 4),
+                numpy.array([face.kps for face in many_faces], dtype=numpy.float32).reshape(-1, 5, 2),
+                numpy.array([face.det_score for face in many_faces], dtype=numpy.float32),
+                numpy.array([face.embedding for face in many_faces], dtype=numpy.float32).reshape(-1, embedding_size)
+            )
+            FACE_INDEX_CHANGED = True
+    bboxes, kpss, det_scores, embeddings = FACE_INDEX[frame_number]
+    # 每次返回新的 Face，调用方补充属性时不会影响索引
+    return [Face(bbox=bboxes[index], kps=kpss[index], det_score=det_scores[index], embedding=embeddings[index]) for index in range(len(det_scores))]
@@ -1,8 +1,10 @@
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from roop.typing import Face
 
 FACE_REFERENCE = None
+# 多人映射：(源人脸, 参考人脸) 列表
+FACE_MAP: List[Tuple[Face, Face]] = []
 
 
 def get_face_reference() -> Optional[Face]:
@@ -19,3 +21,19 @@ def clear_face_reference() -> None:
     global FACE_REFERENCE
 
     FACE_REFERENCE = None
+
+
+def get_face_map() -> List[Tuple[Face, Face]]:
+    return FACE_MAP
+
+
+def set_face_map(face_map: List[Tuple[Face, Face]]) -> None:
+    global FACE_MAP
+
+    FACE_MAP = face_map
+
+
+def clear_face_map() -> None:
+    global FACE_MAP
+
+    FACE_MAP = []
@@ -1,9 +1,9 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
-source_path = None
-target_path = None
+source_path: Optional[str] = None
+target_path: Optional[str] = None
 output_path = None
-headless = None
+headless: Optional[bool] = None
 frame_processors: List[str] = []
 keep_fps = None
 keep_frames = None
@@ -14,12 +14,54 @@ reference_face_position = None
 # 引用/参考 帧数
 reference_frame_number = None
 similar_face_distance = None
+# 多人映射：源人脸 -> 参考人脸
+face_map: List[Dict[str, Any]] = []
+# 只处理目标视频中的这一段帧
+trim_frame_start = None
+trim_frame_end = None
 temp_frame_format = None
 temp_frame_quality = None
+# 临时目录，auto 表示优先使用内存文件系统
+temp_directory = None
+# 稀疏关键帧换脸：关键帧间隔与强制完整换脸的关键点移动阈值
+keyframe_interval = 1
+keyframe_motion_threshold = 0.2
+# 复用目标视频的人脸索引
+face_index = None
+cache_directory = None
+# 相同任务复用缓存的输出，缓存大小上限（GB）
+output_cache = None
+output_cache_size = 10
+# 模型镜像目录或地址
+model_mirror: Optional[str] = None
 output_video_encoder = None
 output_video_quality = None
 max_memory = None
 execution_providers: List[str] = []
 # 最大线程数
 execution_threads = None
+# onnxruntime 会话配置
+execution_profile = 'default'
+# 模型变体
+model_variant = 'fp32'
+# 图像增强器的运行时：auto、onnx 或 torch
+face_enhancer_runtime = 'auto'
+# 只增强较长边在这个范围内的人脸（像素）
+face_enhancer_min_size = 32
+face_enhancer_max_size = None
+# 预读与后写队列深度
+frame_prefetch_depth = 0
+frame_write_depth = 0
+# 分布式处理：远程工作节点、本地工作进程数、作为工作节点时的监听地址与共享密钥
+worker_addresses: List[str] = []
+local_workers = 0
+worker_listen = None
+worker_authkey: Optional[str] = None
+# 实时流：输入、输出、分辨率、帧率、每帧延迟预算（毫秒）与是否循环读取文件
+stream_input: Optional[str] = None
+stream_output: Optional[str] = None
+stream_resolution = None
+stream_fps = None
+stream_latency_budget = None
+stream_loop = None
 log_level = 'error'
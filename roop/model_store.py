@@ -0,0 +1,207 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from tqdm import tqdm
+
+import roop.globals
+
+NAME = 'ROOP.MODEL-STORE'
+DOWNLOAD_THREADS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+# 第一次续传，校验失败后完整重新下载一次
+DOWNLOAD_ATTEMPTS = 2
+SHA256SUMS_FILE = 'SHA256SUMS'
+SHA256_PATTERN = re.compile('^[0-9a-f]{64}$')
+# 镜像的 SHA256SUMS，只读取一次
+MIRROR_HASHES: Optional[Dict[str, str]] = None
+THREAD_LOCK = threading.Lock()
+
+
+"""
+    禁止跟随重定向：huggingface 的 resolve 地址在重定向响应中以 X-Linked-Etag 给出 LFS 文件的 SHA-256
+"""
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args: Any, **kwargs: Any) -> None:
+        return None
+
+
+"""
+    并发下载模型，已校验过的文件直接跳过；任一模型下载或校验失败时返回 False
+"""
+def download_models(download_directory_path: str, urls: List[str]) -> bool:
+    os.makedirs(download_directory_path, exist_ok=True)
+    pending_urls = [url for url in urls if not is_model_verified(os.path.join(download_directory_path, os.path.basename(url)))]
+    if not pending_urls:
+        return True
+    with tqdm(total=0, desc='Downloading', unit='B', unit_scale=True, unit_divisor=1024) as progress:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS) as executor:
+            return all(list(executor.map(lambda url: download_model(download_directory_path, url, progress), pending_urls)))
+
+
+"""
+    下载单个模型：优先从镜像获取，未完成的 .part 文件断点续传，有已知哈希时校验 SHA-256；
+    已存在但校验不通过的文件（多半是中断的下载）当作未完成的文件续传。
+    得不到哈希时接受的文件同样记录校验文件，之后启动不再向原始地址查询哈希（离线时每次都要等到超时）
+"""
+def download_model(download_directory_path: str, url: str, progress: Any) -> bool:
+    model_name = os.path.basename(url)
+    model_path = os.path.join(download_directory_path, model_name)
+    model_part_path = model_path + '.part'
+    expected_hash = get_expected_hash(url)
+    if os.path.isfile(model_path):
+        # 无法得到哈希（离线且镜像没有校验和）时沿用已有文件
+        if expected_hash is None:
+            mark_model_verified(model_path, get_file_hash(model_path))
+            return True
+        if get_file_hash(model_path) == expected_hash:
+            mark_model_verified(model_path, expected_hash)
+            return True
+        os.replace(model_path, model_part_path)
+    for _ in range(DOWNLOAD_ATTEMPTS):
+        if not any(fetch_model(model_source, model_part_path, progress) for model_source in get_model_sources(url)):
+            print(f'[{NAME}] Downloading {model_name} failed.')
+            return False
+        file_hash = get_file_hash(model_part_path)
+        if expected_hash is None or file_hash == expected_hash:
+            os.replace(model_part_path, model_path)
+            mark_model_verified(model_path, file_hash)
+            return True
+        print(f'[{NAME}] Checksum mismatch for {model_name}, expected {expected_hash}, got {file_hash}.')
+        os.remove(model_part_path)
+    return False
+
+
+"""
+    下载来源：镜像目录或镜像地址在前，原始地址在后
+"""
+def get_model_sources(url: str) -> List[str]:
+    model_sources = []
+    if roop.globals.model_mirror:
+        model_sources.append(get_mirror_path(os.path.basename(url)))
+    model_sources.append(url)
+    return model_sources
+
+
+def get_mirror_path(file_name: str) -> str:
+    if is_url(roop.globals.model_mirror):
+        return roop.globals.model_mirror.rstrip('/') + '/' + file_name
+    return os.path.join(roop.globals.model_mirror, file_name)
+
+
+def is_url(path: str) -> bool:
+    return '://' in path
+
+
+"""
+    把来源写入 .part 文件：本地镜像直接复制，远程地址按已有大小发送 Range 续传，服务器不支持时从头下载
+"""
+def fetch_model(model_source: str, model_part_path: str, progress: Any) -> bool:
+    if not is_url(model_source):
+        if not os.path.isfile(model_source):
+            return False
+        shutil.copyfile(model_source, model_part_path)
+        return True
+    offset = os.path.getsize(model_part_path) if os.path.isfile(model_part_path) else 0
+    request = urllib.request.Request(model_source, headers={'Range': f'bytes={offset}-'} if offset else {})
+    try:
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status != 206:
+                offset = 0
+            with THREAD_LOCK:
+                progress.total += offset + int(response.headers.get('Content-Length', 0))
+                progress.update(offset)
+            with open(model_part_path, 'ab' if offset else 'wb') as model_part_file:
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    model_part_file.write(chunk)
+                    progress.update(len(chunk))
+    except urllib.error.HTTPError as exception:
+        # 请求的范围超出文件末尾，说明 .part 已经下载完整
+        return exception.code == 416 and offset > 0
+    except (urllib.error.URLError, OSError):
+        return False
+    return True
+
+
+"""
+    模型的 SHA-256：优先使用镜像中 SHA256SUMS 给出的值，其次使用原始地址响应头中的 X-Linked-Etag 或 ETag；
+    都得不到时返回 None
+"""
+def get_expected_hash(url: str) -> Optional[str]:
+    mirror_hash = get_mirror_hashes().get(os.path.basename(url))
+    if mirror_hash:
+        return mirror_hash
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        headers = urllib.request.build_opener(NoRedirectHandler).open(request, timeout=DOWNLOAD_TIMEOUT).headers
+    except urllib.error.HTTPError as exception:
+        headers = exception.headers
+    except (urllib.error.URLError, OSError):
+        return None
+    for header in ['X-Linked-Etag', 'ETag']:
+        header_hash = (headers.get(header) or '').strip('"').lower()
+        if SHA256_PATTERN.match(header_hash):
+            return header_hash
+    return None
+
+
+"""
+    读取镜像的 SHA256SUMS（sha256sum 的输出格式），镜像没有该文件时为空
+"""
+def get_mirror_hashes() -> Dict[str, str]:
+    global MIRROR_HASHES
+
+    with THREAD_LOCK:
+        if MIRROR_HASHES is None:
+            MIRROR_HASHES = {}
+            if roop.globals.model_mirror:
+                MIRROR_HASHES = parse_sha256sums(read_mirror_file(get_mirror_path(SHA256SUMS_FILE)))
+    return MIRROR_HASHES
+
+
+def read_mirror_file(mirror_path: str) -> str:
+    try:
+        if is_url(mirror_path):
+            with urllib.request.urlopen(mirror_path, timeout=DOWNLOAD_TIMEOUT) as response:
+                return response.read().decode()
+        with open(mirror_path) as mirror_file:
+            return mirror_file.read()
+    except (urllib.error.URLError, OSError, UnicodeDecodeError):
+        return ''
+
+
+def parse_sha256sums(sha256sums: str) -> Dict[str, str]:
+    hashes = {}
+    for line in sha256sums.splitlines():
+        file_hash, _, file_name = line.strip().partition(' ')
+        file_name = file_name.strip().lstrip('*')
+        if SHA256_PATTERN.match(file_hash.lower()) and file_name:
+            hashes[os.path.basename(file_name)] = file_hash.lower()
+    return hashes
+
+
+def get_file_hash(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+"""
+    校验通过的模型旁写一个 .sha256 文件，之后启动时无需联网或重新计算哈希
+"""
+def mark_model_verified(model_path: str, file_hash: str) -> None:
+    with open(model_path + '.sha256', 'w') as hash_file:
+        hash_file.write(f'{file_hash}  {os.path.basename(model_path)}\n')
+
+
+def is_model_verified(model_path: str) -> bool:
+    hash_path = model_path + '.sha256'
+    return os.path.isfile(model_path) and os.path.isfile(hash_path) and os.path.getmtime(hash_path) >= os.path.getmtime(model_path)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Dict, List, Tuple
+
+import roop.globals
+import roop.metadata
+from roop.face_index import get_content_hash
+
+# 影响输出结果的选项；执行器、线程数、队列深度等只影响速度的选项不参与
+OUTPUT_CACHE_OPTIONS = [
+    'frame_processors',
+    'keep_fps',
+    'skip_audio',
+    'many_faces',
+    'reference_face_position',
+    'reference_frame_number',
+    'similar_face_distance',
+    'trim_frame_start',
+    'trim_frame_end',
+    'temp_frame_format',
+    'temp_frame_quality',
+    'output_video_encoder',
+    'output_video_quality',
+    'model_variant',
+    'face_enhancer_runtime',
+    'face_enhancer_min_size',
+    'face_enhancer_max_size',
+    'keyframe_interval',
+    'keyframe_motion_threshold'
+]
+THREAD_LOCK = threading.Lock()
+
+
+def get_output_cache_directory() -> str:
+    return os.path.join(roop.globals.cache_directory, 'outputs')
+
+
+"""
+    参与缓存键的文件都存在时才能计算键；查找早于处理器的输入检查，缺失的文件留给检查去报告
+"""
+def has_output_cache_inputs(source_path: str, target_path: str) -> bool:
+    input_paths = [source_path, target_path]
+    input_paths.extend(face_map_entry[key] for face_map_entry in roop.globals.face_map for key in ['source', 'reference'] if face_map_entry.get(key))
+    return all(input_path and os.path.isfile(input_path) for input_path in input_paths)
+
+
+"""
+    输出缓存的键：源文件、目标文件与多人映射中各图片的内容哈希，加上处理器列表与影响输出的选项
+"""
+def get_output_cache_key(source_path: str, target_path: str) -> str:
+    output_cache_settings = {
+        'version': roop.metadata.version,
+        'source_hash': get_content_hash(source_path),
+        'target_hash': get_content_hash(target_path),
+        'face_map': [{key: get_content_hash(value) if key in ['source', 'reference'] and value else value for key, value in face_map_entry.items()} for face_map_entry in roop.globals.face_map],
+        'options': {option: getattr(roop.globals, option) for option in OUTPUT_CACHE_OPTIONS}
+    }
+    return hashlib.sha256(json.dumps(output_cache_settings, sort_keys=True).encode()).hexdigest()
+
+
+def get_output_cache_path(output_cache_key: str, output_path: str) -> str:
+    return os.path.join(get_output_cache_directory(), output_cache_key + os.path.splitext(output_path)[1])
+
+
+"""
+    命中时把缓存的输出复制到输出路径，并刷新修改时间作为最近使用时间
+"""
+def restore_cached_output(output_cache_key: str, output_path: str) -> bool:
+    output_cache_path = get_output_cache_path(output_cache_key, output_path)
+    if not os.path.isfile(output_cache_path):
+        return False
+    os.utime(output_cache_path)
+    shutil.copyfile(output_cache_path, output_path)
+    return True
+
+
+"""
+    保存输出到缓存，先写临时文件再替换，之后按大小上限淘汰
+"""
+def store_cached_output(output_cache_key: str, output_path: str) -> None:
+    output_cache_path = get_output_cache_path(output_cache_key, output_path)
+    os.makedirs(os.path.dirname(output_cache_path), exist_ok=True)
+    shutil.copyfile(output_path, output_cache_path + '.part')
+    os.replace(output_cache_path + '.part', output_cache_path)
+    evict_cached_outputs(int(roop.globals.output_cache_size * 1024 ** 3))
+
+
+"""
+    LRU 淘汰：按最近使用时间从旧到新删除，直到总大小不超过上限，返回删除的文件数
+"""
+def evict_cached_outputs(size_limit: int) -> int:
+    with THREAD_LOCK:
+        entries = get_cached_outputs()
+        cache_size = sum(size for _, size, _ in entries)
+        evict_total = 0
+        for output_cache_path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if cache_size <= size_limit:
+                break
+            os.remove(output_cache_path)
+            cache_size -= size
+            evict_total += 1
+    return evict_total
+
+
+"""
+    缓存中的输出：(路径, 大小, 最近使用时间)
+"""
+def get_cached_outputs() -> List[Tuple[str, int, float]]:
+    output_cache_directory = get_output_cache_directory()
+    if not os.path.isdir(output_cache_directory):
+        return []
+    entries = []
+    for file_name in os.listdir(output_cache_directory):
+        output_cache_path = os.path.join(output_cache_directory, file_name)
+        if file_name.endswith('.part') or not os.path.isfile(output_cache_path):
+            continue
+        stat = os.stat(output_cache_path)
+        entries.append((output_cache_path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def get_output_cache_stats() -> Dict[str, int]:
+    entries = get_cached_outputs()
+    return {'output_total': len(entries), 'cache_size': sum(size for _, size, _ in entries)}
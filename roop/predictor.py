@@ -1,44 +1,117 @@
+import io
+import os
 import threading
+from typing import Any, List
+import cv2
 import numpy
-import opennsfw2
+import onnxruntime
 from PIL import Image
-from keras import Model
 
+import roop.globals
+from roop.execution import create_session_options
 from roop.typing import Frame
+from roop.utilities import resolve_relative_path
 
 PREDICTOR = None
 THREAD_LOCK = threading.Lock()
 MAX_PROBABILITY = 0.85
+# 与 opennsfw2.predict_video_frames 相同的抽帧间隔与聚合窗口
+FRAME_INTERVAL = 100
+AGGREGATION_SIZE = 8
+# YAHOO 预处理：缩放到 256 后中心裁剪 224，BGR 通道减去训练集均值
+PREDICTOR_INPUT_SIZE = 224
+PREDICTOR_RESIZE_SIZE = 256
+PREDICTOR_MEAN = numpy.array([104, 117, 123], dtype=numpy.float32)
 
 
-def get_predictor() -> Model:
+"""
+    加载 鉴黄 模型 opennsfw2 的 onnx 版本，与人脸模型共用执行器与会话配置
+"""
+def get_predictor() -> onnxruntime.InferenceSession:
     global PREDICTOR
 
     with THREAD_LOCK:
         if PREDICTOR is None:
-            # 加载 鉴黄 模型 opennsfw2
-            PREDICTOR = opennsfw2.make_open_nsfw_model()
+            model_path = prepare_predictor_model(resolve_relative_path('../models/open_nsfw.onnx'))
+            PREDICTOR = onnxruntime.InferenceSession(model_path, sess_options=create_session_options(model_path), providers=roop.globals.execution_providers)
     return PREDICTOR
 
 
+"""
+    首次使用时把 opennsfw2 的 Keras 模型转换为 onnx，批量维度为动态；只有转换时才需要 tensorflow
+"""
+def prepare_predictor_model(model_path: str) -> str:
+    if not os.path.isfile(model_path):
+        import opennsfw2
+        import tensorflow
+        import tf2onnx
+
+        input_signature = [tensorflow.TensorSpec((None, PREDICTOR_INPUT_SIZE, PREDICTOR_INPUT_SIZE, 3), tensorflow.float32, name='input')]
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        tf2onnx.convert.from_keras(opennsfw2.make_open_nsfw_model(), input_signature=input_signature, output_path=model_path + '.part')
+        os.replace(model_path + '.part', model_path)
+    return model_path
+
+
 def clear_predictor() -> None:
     global PREDICTOR
 
     PREDICTOR = None
 
 
+"""
+    与 opennsfw2.preprocess_image(Preprocessing.YAHOO) 一致：双线性缩放、JPEG 往返、中心裁剪、RGB 转 BGR 并减均值
+"""
+def preprocess_image(image: Image.Image) -> Any:
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image = image.resize((PREDICTOR_RESIZE_SIZE, PREDICTOR_RESIZE_SIZE), resample=Image.BILINEAR)
+    image_buffer = io.BytesIO()
+    image.save(image_buffer, format='JPEG')
+    image_buffer.seek(0)
+    views = numpy.array(Image.open(image_buffer), dtype=numpy.float32)
+    offset = (PREDICTOR_RESIZE_SIZE - PREDICTOR_INPUT_SIZE) // 2
+    views = views[offset:offset + PREDICTOR_INPUT_SIZE, offset:offset + PREDICTOR_INPUT_SIZE, ::-1]
+    return views - PREDICTOR_MEAN
+
+
+"""
+    一次推理预测一批图像，返回每张图的 NSFW 概率
+"""
+def predict_probabilities(images: List[Image.Image]) -> List[float]:
+    predictor = get_predictor()
+    views = numpy.stack([preprocess_image(image) for image in images])
+    probabilities = predictor.run(None, {predictor.get_inputs()[0].name: views})[0]
+    return probabilities[:, 1].tolist()
+
+
 def predict_frame(target_frame: Frame) -> bool:
-    image = Image.fromarray(target_frame)
-    image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
-    views = numpy.expand_dims(image, axis=0)
-    _, probability = get_predictor().predict(views)[0]
-    return probability > MAX_PROBABILITY
+    return predict_probabilities([Image.fromarray(target_frame)])[0] > MAX_PROBABILITY
 
 
 def predict_image(target_path: str) -> bool:
-    return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+    return predict_probabilities([Image.open(target_path)])[0] > MAX_PROBABILITY
 
 
+"""
+    与 opennsfw2.predict_video_frames 相同的判定：第一帧单独预测，之后每 100 帧抽一帧，
+    凑满 8 帧为一批一次推理并取平均概率，末尾不足一批的帧不参与；只解码抽中的帧
+"""
 def predict_video(target_path: str) -> bool:
-    _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
-    return any(probability > MAX_PROBABILITY for probability in probabilities)
+    capture = cv2.VideoCapture(target_path)
+    frames: List[Image.Image] = []
+    frame_count = 0
+    while capture.grab():
+        frame_count += 1
+        if frame_count == 1 or (frame_count + 1) % FRAME_INTERVAL == 0:
+            has_frame, frame = capture.retrieve()
+            if not has_frame:
+                break
+            frames.append(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+            if frame_count == 1 or len(frames) >= AGGREGATION_SIZE:
+                if numpy.mean(predict_probabilities(frames)) > MAX_PROBABILITY:
+                    capture.release()
+                    return True
+                frames = []
+    capture.release()
+    return False
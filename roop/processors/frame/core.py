@@ -1,22 +1,37 @@
 import os
 import sys
 import importlib
+import threading
+import cv2
+import numpy
 import psutil
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
+from contextlib import contextmanager
+from queue import Queue, Full
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, BinaryIO, Dict, List, Callable, Iterator, Optional, Set, Tuple
 from tqdm import tqdm
 
-import roop
+import roop.globals
+from roop.typing import Face, Frame
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+# 当前处理器没有修改、因此无需重新写入的帧
+UNTOUCHED_FRAME_PATHS: Set[str] = set()
+# 换脸器在每帧中实际替换过的人脸，按帧路径记录，供人脸增强只处理这些人脸
+SWAPPED_FACES: Dict[str, List[Face]] = {}
+# 逐帧调用（预览、实时流）时，记录当前线程最近一次换脸的帧与人脸
+SWAPPED_FRAME = threading.local()
+THREAD_LOCK = threading.Lock()
+# 每个工作线程独立的帧缓冲池
+FRAME_BUFFERS = threading.local()
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
     'process_frame',
     'process_frames',
     'process_image',
+    'process_images',
     'process_video',
     'post_process'
 ]
@@ -93,11 +108,25 @@ def process_video(source_path: str, frame_paths: list[str], process_frames: Call
     # 进度条？
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(frame_paths)
+    clear_untouched_frames()
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
         # 多线程处理帧数据
         multi_process_frame(source_path, frame_paths, process_frames, lambda: update_progress(progress))
 
 
+"""
+    多线程批量处理图片，每张图片由工作线程读取、处理并写出
+"""
+def process_images(source_path: str, target_paths: List[str], output_paths: List[str], process_image: Callable[[str, str, str], None]) -> None:
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    with tqdm(total=len(target_paths), desc='Processing', unit='image', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
+            futures = [executor.submit(process_image, source_path, target_path, output_path) for target_path, output_path in zip(target_paths, output_paths)]
+            for future in as_completed(futures):
+                future.result()
+                update_progress(progress)
+
+
 """
     更新进度条
 """
@@ -110,7 +139,175 @@ def update_progress(progress: Any = None) -> None:
         # 空闲线程数
         'execution_providers': roop.globals.execution_providers,
         # 使用线程数
-        'execution_threads': roop.globals.execution_threads
+        'execution_threads': roop.globals.execution_threads,
+        # 没有人脸、跳过写入的帧数
+        'untouched_frames': len(UNTOUCHED_FRAME_PATHS)
     })
     progress.refresh()
     progress.update(1)
+
+
+"""
+    记录未被修改的帧，跳过重新编码写入
+"""
+def mark_untouched_frame(frame_path: str) -> None:
+    with THREAD_LOCK:
+        UNTOUCHED_FRAME_PATHS.add(frame_path)
+
+
+def clear_untouched_frames() -> None:
+    with THREAD_LOCK:
+        UNTOUCHED_FRAME_PATHS.clear()
+
+
+"""
+    记录换脸结果中的人脸，只保留人脸框、关键点与分数；没有换脸的帧记录为空列表
+"""
+def record_swapped_faces(frame_path: str, target_faces: List[Face]) -> None:
+    swapped_faces = [Face(bbox=target_face.bbox, kps=target_face.kps, det_score=target_face.det_score) for target_face in target_faces]
+    with THREAD_LOCK:
+        SWAPPED_FACES[frame_path] = swapped_faces
+
+
+"""
+    换脸器没有处理过该帧时返回 None
+"""
+def get_swapped_faces(frame_path: str) -> Optional[List[Face]]:
+    return SWAPPED_FACES.get(frame_path)
+
+
+def record_swapped_frame(frame: Frame, target_faces: List[Face]) -> None:
+    SWAPPED_FRAME.frame = frame
+    SWAPPED_FRAME.faces = target_faces
+
+
+"""
+    传入的正是当前线程最近一次换脸返回的帧时，返回其中替换过的人脸，否则返回 None
+"""
+def get_swapped_frame_faces(frame: Frame) -> Optional[List[Face]]:
+    if getattr(SWAPPED_FRAME, 'frame', None) is frame:
+        return SWAPPED_FRAME.faces
+    return None
+
+
+def clear_swapped_faces() -> None:
+    with THREAD_LOCK:
+        SWAPPED_FACES.clear()
+    SWAPPED_FRAME.__dict__.clear()
+
+
+"""
+    从当前线程的缓冲池取出预分配的连续数组，按名称复用，只在需要更大空间时重新分配
+"""
+def get_frame_buffer(name: str, shape: Tuple[int, ...], dtype: Any = numpy.uint8) -> Any:
+    frame_buffers = FRAME_BUFFERS.__dict__.setdefault('frame_buffers', {})
+    size = int(numpy.prod(shape))
+    frame_buffer = frame_buffers.get(name)
+    if frame_buffer is None or frame_buffer.dtype != dtype or frame_buffer.size < size:
+        frame_buffer = numpy.empty(size, dtype=dtype)
+        frame_buffers[name] = frame_buffer
+    return frame_buffer[:size].reshape(shape)
+
+
+"""
+    预读帧：后台线程提前解码后续帧，队列深度由 frame_prefetch_depth 决定，为 0 时同步读取
+"""
+def read_frames(frame_paths: List[str]) -> Iterator[Tuple[str, Frame]]:
+    if roop.globals.frame_prefetch_depth <= 0:
+        for frame_path in frame_paths:
+            yield frame_path, cv2.imread(frame_path)
+        return
+    queue: Queue[Optional[Tuple[str, Frame]]] = Queue(maxsize=roop.globals.frame_prefetch_depth)
+    stop_event = threading.Event()
+
+    def put_frame(item: Optional[Tuple[str, Frame]]) -> None:
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def prefetch_frames() -> None:
+        for frame_path in frame_paths:
+            if stop_event.is_set():
+                return
+            put_frame((frame_path, cv2.imread(frame_path)))
+        put_frame(None)
+
+    thread = threading.Thread(target=prefetch_frames, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        # 消费方提前退出时通知预读线程停止
+        stop_event.set()
+        thread.join()
+
+
+"""
+    后写帧：后台线程负责编码并写入磁盘，队列深度由 frame_write_depth 决定，为 0 时同步写入；
+    后台写入出错后继续排空队列，错误在下一次写帧或退出时抛给处理线程
+"""
+@contextmanager
+def write_frames() -> Iterator[Callable[[str, Frame], None]]:
+    if roop.globals.frame_write_depth <= 0:
+        yield write_frame
+        return
+    queue: Queue[Optional[Tuple[str, Frame]]] = Queue(maxsize=roop.globals.frame_write_depth)
+    write_exceptions: List[Exception] = []
+
+    def write_behind() -> None:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if write_exceptions:
+                continue
+            try:
+                write_frame(*item)
+            except Exception as exception:
+                write_exceptions.append(exception)
+
+    def queue_frame(frame_path: str, frame: Frame) -> None:
+        if write_exceptions:
+            raise write_exceptions[0]
+        queue.put((frame_path, frame))
+
+    thread = threading.Thread(target=write_behind, daemon=True)
+    thread.start()
+    try:
+        yield queue_frame
+    finally:
+        # 等待所有帧写完
+        queue.put(None)
+        thread.join()
+    if write_exceptions:
+        raise write_exceptions[0]
+
+
+def write_frame(frame_path: str, frame: Frame) -> None:
+    if not cv2.imwrite(frame_path, frame):
+        raise OSError(f'Writing frame {frame_path} failed.')
+
+
+"""
+    从 rawvideo 流直接读入预分配的帧，不经过中间字节串，流结束时返回 False
+"""
+def read_raw_frame(stream: BinaryIO, frame: Frame) -> bool:
+    frame_buffer = frame.data.cast('B')
+    position = 0
+    while position < len(frame_buffer):
+        size = stream.readinto(frame_buffer[position:])  # type: ignore[attr-defined]
+        if not size:
+            return False
+        position += size
+    return True
+
+
+def write_raw_frame(stream: BinaryIO, frame: Frame) -> None:
+    stream.write(frame.data.cast('B'))
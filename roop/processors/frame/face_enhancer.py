@@ -1,19 +1,47 @@
-from typing import Any, List, Callable
+import os
+from typing import Any, List, Callable, Optional
 import cv2
+import numpy
+import onnxruntime
 import threading
+import torch
+from gfpgan.archs.stylegan2_clean_arch import ModulatedConv2d
 from gfpgan.utils import GFPGANer
 
 import roop.globals
 import roop.processors.frame.core
 from roop.core import update_status
+from roop.execution import create_session_options
 from roop.face_analyser import get_many_faces
+from roop.face_index import get_indexed_faces
+from roop.processors.frame.face_swapper import paste_back
 from roop.typing import Frame, Face
-from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, is_batch_target
 
 FACE_ENHANCER = None
+# onnx 版本的 GFPGAN 会话，以及实际使用的运行时（onnx 或 torch）
+FACE_ENHANCER_SESSION = None
+FACE_ENHANCER_RUNTIME = None
 THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-ENHANCER'
+FACE_ENHANCER_SIZE = 512
+FACE_ENHANCER_BATCH_SIZE = 8
+# facexlib 中 512x512 FFHQ 人脸的 5 点模板与补边颜色
+FACE_TEMPLATE = numpy.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935], [201.26117, 371.41043], [313.08905, 371.15118]], dtype=numpy.float32)
+FACE_BORDER_VALUE = (135, 133, 132)
+
+
+"""
+    导出用的包装：固定使用模型内置的噪声，只输出恢复后的人脸
+"""
+class FaceEnhancerExport(torch.nn.Module):
+    def __init__(self, gfpgan: Any) -> None:
+        super().__init__()
+        self.gfpgan = gfpgan
+
+    def forward(self, crop_frames: Any) -> Any:
+        return self.gfpgan(crop_frames, return_rgb=False, randomize_noise=False)[0]
 
 # 图像增强器
 def get_face_enhancer() -> Any:
@@ -38,21 +66,87 @@ def get_device() -> str:
     return 'cpu'
 
 
+"""
+    获取 onnx 版本的图像增强器，auto 时导出或加载失败退回 torch 并返回 None
+"""
+def get_face_enhancer_session() -> Optional[onnxruntime.InferenceSession]:
+    global FACE_ENHANCER_SESSION, FACE_ENHANCER_RUNTIME
+
+    with THREAD_LOCK:
+        if FACE_ENHANCER_RUNTIME is None:
+            FACE_ENHANCER_RUNTIME = 'torch'
+            if roop.globals.face_enhancer_runtime != 'torch':
+                try:
+                    model_path = prepare_face_enhancer_model(resolve_relative_path('../models/GFPGANv1.4.onnx'))
+                    FACE_ENHANCER_SESSION = onnxruntime.InferenceSession(model_path, sess_options=create_session_options(model_path), providers=roop.globals.execution_providers)
+                    FACE_ENHANCER_RUNTIME = 'onnx'
+                except Exception as exception:
+                    if roop.globals.face_enhancer_runtime == 'onnx':
+                        raise
+                    update_status(f'Loading GFPGAN with onnxruntime failed, falling back to torch: {exception}', NAME)
+    return FACE_ENHANCER_SESSION
+
+
+"""
+    首次使用时把 GFPGAN v1.4 导出为 onnx，批量维度为动态
+"""
+def prepare_face_enhancer_model(model_path: str) -> str:
+    if not os.path.isfile(model_path):
+        gfpgan = GFPGANer(model_path=resolve_relative_path('../models/GFPGANv1.4.pth'), upscale=1, device='cpu').gfpgan
+        modulated_conv_forward = ModulatedConv2d.forward
+        # 原实现把批量折进分组卷积的 groups，导出后批量大小固定，导出时换成等价的逐样本调制
+        ModulatedConv2d.forward = forward_modulated_conv
+        try:
+            with torch.no_grad():
+                torch.onnx.export(
+                    FaceEnhancerExport(gfpgan),
+                    torch.zeros(1, 3, FACE_ENHANCER_SIZE, FACE_ENHANCER_SIZE),
+                    model_path + '.part',
+                    input_names=['input'],
+                    output_names=['output'],
+                    dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+                    opset_version=14
+                )
+        finally:
+            ModulatedConv2d.forward = modulated_conv_forward
+        os.replace(model_path + '.part', model_path)
+    return model_path
+
+
+"""
+    与 ModulatedConv2d.forward 等价：先按样本缩放输入通道，共享权重卷积，再按样本解调输出通道
+"""
+def forward_modulated_conv(self: Any, x: Any, style: Any) -> Any:
+    batch_size, channel_total = x.shape[:2]
+    style = self.modulation(style).view(batch_size, 1, channel_total, 1, 1)
+    x = x * style.view(batch_size, channel_total, 1, 1)
+    if self.sample_mode == 'upsample':
+        x = torch.nn.functional.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False)
+    elif self.sample_mode == 'downsample':
+        x = torch.nn.functional.interpolate(x, scale_factor=0.5, mode='bilinear', align_corners=False)
+    out = torch.nn.functional.conv2d(x, self.weight[0], padding=self.padding)
+    if self.demodulate:
+        demod = torch.rsqrt((self.weight * style).pow(2).sum([2, 3, 4]) + self.eps)
+        out = out * demod.view(batch_size, self.out_channels, 1, 1)
+    return out
+
+
 def clear_face_enhancer() -> None:
-    global FACE_ENHANCER
+    global FACE_ENHANCER, FACE_ENHANCER_SESSION, FACE_ENHANCER_RUNTIME
 
     FACE_ENHANCER = None
+    FACE_ENHANCER_SESSION = None
+    FACE_ENHANCER_RUNTIME = None
 
 
 def pre_check() -> bool:
     download_directory_path = resolve_relative_path('../models')
-    conditional_download(download_directory_path, ['https://huggingface.co/henryruhs/roop/resolve/main/GFPGANv1.4.pth'])
-    return True
+    return conditional_download(download_directory_path, ['https://huggingface.co/henryruhs/roop/resolve/main/GFPGANv1.4.pth'])
 
 
 def pre_start() -> bool:
-    if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path):
-        update_status('Select an image or video for target path.', NAME)
+    if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path) and not is_batch_target(roop.globals.target_path):
+        update_status('Select an image, video or image directory for target path.', NAME)
         return False
     return True
 
@@ -87,13 +181,54 @@ def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
 
 
 """
-    处理图像帧
+    onnx 运行时：按 insightface 关键点对齐到 512 模板，一帧中的所有人脸成批推理，再贴回原帧；
+    torch 运行时逐个人脸调用 GFPGANer
 """
-def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
-    many_faces = get_many_faces(temp_frame)
-    if many_faces:
-        for target_face in many_faces:
+def enhance_faces(target_faces: List[Face], temp_frame: Frame) -> Frame:
+    session = get_face_enhancer_session()
+    if session is None:
+        for target_face in target_faces:
             temp_frame = enhance_face(target_face, temp_frame)
+        return temp_frame
+    affine_matrices = [cv2.estimateAffinePartial2D(target_face.kps, FACE_TEMPLATE, method=cv2.LMEDS)[0] for target_face in target_faces]
+    crop_frames = [cv2.warpAffine(temp_frame, affine_matrix, (FACE_ENHANCER_SIZE, FACE_ENHANCER_SIZE), borderMode=cv2.BORDER_CONSTANT, borderValue=FACE_BORDER_VALUE) for affine_matrix in affine_matrices]
+    restored_frames: List[Frame] = []
+    for index in range(0, len(crop_frames), FACE_ENHANCER_BATCH_SIZE):
+        # BGR 转 RGB，归一化到 [-1, 1]
+        crop_batch = numpy.stack(crop_frames[index:index + FACE_ENHANCER_BATCH_SIZE])[:, :, :, ::-1].transpose(0, 3, 1, 2).astype(numpy.float32) / 127.5 - 1
+        restored_batch = session.run(None, {session.get_inputs()[0].name: crop_batch})[0]
+        restored_batch = ((numpy.clip(restored_batch, -1, 1) + 1) * 127.5).round().astype(numpy.uint8)
+        restored_frames.extend(numpy.ascontiguousarray(restored_batch.transpose(0, 2, 3, 1)[:, :, :, ::-1]))
+    for restored_frame, affine_matrix in zip(restored_frames, affine_matrices):
+        temp_frame = paste_back(temp_frame, restored_frame, affine_matrix)
+    return temp_frame
+
+
+"""
+    人脸框较长边在尺寸范围内才值得增强：太小的人脸增强后看不出差别，太大的人脸会被缩到 512 再贴回
+"""
+def filter_face_sizes(many_faces: List[Face]) -> List[Face]:
+    target_faces = []
+    for target_face in many_faces:
+        start_x, start_y, end_x, end_y = target_face.bbox
+        face_size = max(end_x - start_x, end_y - start_y)
+        if face_size >= roop.globals.face_enhancer_min_size and (not roop.globals.face_enhancer_max_size or face_size <= roop.globals.face_enhancer_max_size):
+            target_faces.append(target_face)
+    return target_faces
+
+
+"""
+    处理图像帧，many_faces 为调用方已解析的人脸；前面的换脸器刚处理过这一帧时只增强替换过的人脸
+"""
+def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame, many_faces: Optional[List[Face]] = None) -> Frame:
+    swapped_faces = roop.processors.frame.core.get_swapped_frame_faces(temp_frame)
+    if swapped_faces is not None:
+        many_faces = swapped_faces
+    elif many_faces is None:
+        many_faces = get_many_faces(temp_frame)
+    many_faces = filter_face_sizes(many_faces or [])
+    if many_faces:
+        temp_frame = enhance_faces(many_faces, temp_frame)
     return temp_frame
 
 
@@ -101,16 +236,26 @@ def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) ->
     处理视频的每一帧
 """
 def process_frames(source_path: str, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
-    # 遍历视频帧
-    for temp_frame_path in temp_frame_paths:
-        # 使用openCV 加载 图像帧
-        temp_frame = cv2.imread(temp_frame_path)
-        # 处理图像帧
-        result = process_frame(None, None, temp_frame)
-        # 将处理后的帧显示出来
-        cv2.imwrite(temp_frame_path, result)
-        if update:
-            update()
+    with roop.processors.frame.core.write_frames() as write_frame:
+        # 遍历视频帧，由后台线程预读
+        for temp_frame_path, temp_frame in roop.processors.frame.core.read_frames(temp_frame_paths):
+            # 优先使用换脸器替换过的人脸，其次人脸索引中的人脸框
+            many_faces = roop.processors.frame.core.get_swapped_faces(temp_frame_path)
+            if many_faces is None:
+                many_faces = get_indexed_faces(temp_frame_path, temp_frame)
+            if many_faces is None:
+                many_faces = get_many_faces(temp_frame)
+            many_faces = filter_face_sizes(many_faces or [])
+            if many_faces:
+                # 增强每一张人脸
+                temp_frame = enhance_faces(many_faces, temp_frame)
+                # 将处理后的帧交给后台线程写回
+                write_frame(temp_frame_path, temp_frame)
+            else:
+                # 没有人脸，跳过写入
+                roop.processors.frame.core.mark_untouched_frame(temp_frame_path)
+            if update:
+                update()
 
 
 """
@@ -119,8 +264,8 @@ def process_frames(source_path: str, temp_frame_paths: List[str], update: Callab
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
     # openCV 读取图像
     target_frame = cv2.imread(target_path)
-    # 处理图像帧
-    result = process_frame(None, None, target_frame)
+    # 处理图像帧，换脸器写出的图片只增强替换过的人脸
+    result = process_frame(None, None, target_frame, roop.processors.frame.core.get_swapped_faces(target_path))
     # 显示图像帧
     cv2.imwrite(output_path, result)
 
@@ -130,3 +275,10 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 """
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
     roop.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+
+
+"""
+    批量处理图片
+"""
+def process_images(source_path: str, target_paths: List[str], output_paths: List[str]) -> None:
+    roop.processors.frame.core.process_images(source_path, target_paths, output_paths, process_image)
@@ -1,19 +1,42 @@
-from typing import Any, List, Callable
+import os
+from typing import Any, Dict, List, Callable, NamedTuple, Optional, Tuple
 import cv2
 import insightface
+import numpy
+import onnxruntime
 import threading
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.utils import face_align
 
 import roop.globals
 import roop.processors.frame.core
 from roop.core import update_status
-from roop.face_analyser import get_one_face, get_many_faces, find_similar_face
-from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference
+from roop.capturer import get_video_frame
+from roop.execution import create_session_options, get_model_variant_path, prepare_model_variant, get_model_variant_report, set_model_variant_report
+from roop.face_analyser import get_one_face, get_many_faces, find_similar_face, find_similar_faces, calculate_bbox_overlap
+from roop.face_index import get_indexed_faces
+from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference, get_face_map, set_face_map, clear_face_map
 from roop.typing import Face, Frame
-from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, is_batch_target
 
 FACE_SWAPPER = None
 THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-SWAPPER'
+# 模型变体相对 fp32 的最低质量要求
+MODEL_VARIANT_MIN_SIMILARITY = 0.95
+MODEL_VARIANT_MIN_PSNR = 30.0
+# 稀疏关键帧：对齐后关键点相对关键帧的最大偏移（128 像素的对齐空间），超出视为表情变化
+KEYFRAME_EXPRESSION_THRESHOLD = 1.5
+# 每个线程记录上一帧的帧号与各人脸的关键帧
+KEYFRAME = threading.local()
+
+
+class KeyframeFace(NamedTuple):
+    source_face: Face
+    kps: Any
+    swap_frame: Frame
+    affine_matrix: Any
+    frame_number: int
 
 
 """
@@ -26,8 +49,10 @@ def get_face_swapper() -> Any:
         if FACE_SWAPPER is None:
             # 模型路径
             model_path = resolve_relative_path('../models/inswapper_128.onnx')
-            # 加载模型， INSwapper
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=roop.globals.execution_providers)
+            variant_path = prepare_model_variant(model_path, get_model_variant_path(model_path))
+            session = onnxruntime.InferenceSession(variant_path, sess_options=create_session_options(variant_path), providers=roop.globals.execution_providers)
+            # 加载模型， INSwapper，emap 从 fp32 模型读取，推理使用变体的会话
+            FACE_SWAPPER = INSwapper(model_file=model_path, session=session)
     return FACE_SWAPPER
 
 
@@ -40,70 +65,288 @@ def clear_face_swapper() -> None:
 def pre_check() -> bool:
     download_directory_path = resolve_relative_path('../models')
     # 检查模型是否已经下载
-    conditional_download(download_directory_path, ['https://huggingface.co/henryruhs/roop/resolve/main/inswapper_128.onnx'])
-    return True
+    return conditional_download(download_directory_path, ['https://huggingface.co/henryruhs/roop/resolve/main/inswapper_128.onnx'])
 
 
 def pre_start() -> bool:
+    for face_map_entry in roop.globals.face_map:
+        if not is_image(face_map_entry['source']) or not get_one_face(cv2.imread(face_map_entry['source'])):
+            update_status(f'No face in face map source {face_map_entry["source"]} detected.', NAME)
+            return False
+        if face_map_entry.get('reference') and (not is_image(face_map_entry['reference']) or not get_one_face(cv2.imread(face_map_entry['reference']))):
+            update_status(f'No face in face map reference {face_map_entry["reference"]} detected.', NAME)
+            return False
     if not is_image(roop.globals.source_path):
         update_status('Select an image for source path.', NAME)
         return False
     elif not get_one_face(cv2.imread(roop.globals.source_path)):
         update_status('No face in source path detected.', NAME)
         return False
-    if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path):
-        update_status('Select an image or video for target path.', NAME)
+    if roop.globals.model_variant != 'fp32':
+        check_model_variant(cv2.imread(roop.globals.source_path))
+    if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path) and not is_batch_target(roop.globals.target_path):
+        update_status('Select an image, video or image directory for target path.', NAME)
         return False
     return True
 
 
+"""
+    在源人脸上比较模型变体与 fp32 基线：检测框交并比、识别特征余弦相似度、换脸结果 PSNR
+"""
+def check_model_variant(source_frame: Frame) -> None:
+    variant_path = get_model_variant_path(resolve_relative_path('../models/inswapper_128.onnx'))
+    report = get_model_variant_report(variant_path)
+    if report is None:
+        report = create_model_variant_report(source_frame)
+        set_model_variant_report(variant_path, report)
+    update_status(f'Model variant {roop.globals.model_variant}: detector overlap {report["detector_overlap"]:.3f}, recognizer similarity {report["recognizer_similarity"]:.3f}, swapper psnr {report["swapper_psnr"]:.1f} dB.', NAME)
+    if not report['detector_overlap'] or report['recognizer_similarity'] < MODEL_VARIANT_MIN_SIMILARITY or report['swapper_psnr'] < MODEL_VARIANT_MIN_PSNR:
+        update_status(f'Model variant {roop.globals.model_variant} deviates from fp32, consider --model-variant optimized.', NAME)
+
+
+def create_model_variant_report(source_frame: Frame) -> Dict[str, float]:
+    model_path = resolve_relative_path('../models/inswapper_128.onnx')
+    baseline_analyser = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.execution_providers, allowed_modules=['detection', 'recognition'])
+    baseline_analyser.prepare(ctx_id=0)
+    baseline_faces = baseline_analyser.get(source_frame)
+    variant_faces = get_many_faces(source_frame) or []
+    # 任一检测器找不到人脸本身就是偏差，重合度与识别相似度记为 0
+    report = {'detector_overlap': 0.0, 'recognizer_similarity': 0.0, 'swapper_psnr': 0.0}
+    if baseline_faces and variant_faces:
+        baseline_face = baseline_faces[0]
+        variant_face = max(variant_faces, key=lambda face: calculate_bbox_overlap(face.bbox, baseline_face.bbox))
+        report['detector_overlap'] = calculate_bbox_overlap(baseline_face.bbox, variant_face.bbox)
+        report['recognizer_similarity'] = float(numpy.dot(baseline_face.normed_embedding, variant_face.normed_embedding))
+    # 换脸模型用找到的人脸比较，两个检测器都找不到时无法比较
+    compare_faces = baseline_faces or variant_faces
+    if compare_faces:
+        baseline_swapper = insightface.model_zoo.get_model(model_path, providers=roop.globals.execution_providers)
+        baseline_swap_frame, _ = baseline_swapper.get(source_frame, compare_faces[0], compare_faces[0], paste_back=False)
+        variant_swap_frame, _ = get_face_swapper().get(source_frame, compare_faces[0], compare_faces[0], paste_back=False)
+        report['swapper_psnr'] = float(cv2.PSNR(baseline_swap_frame, variant_swap_frame))
+    return report
+
+
 def post_process() -> None:
     clear_face_swapper()
     clear_face_reference()
+    clear_face_map()
 
 
 """
     换脸
 """
 def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    # 获取 换脸器
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+    # 获取 换脸器，只取对齐后的换脸结果，由 paste_back 贴回原帧
+    swap_frame, affine_matrix = get_face_swapper().get(temp_frame, target_face, source_face, paste_back=False)
+    return paste_back(temp_frame, swap_frame, affine_matrix)
+
+
+"""
+    将换脸结果贴回原帧，只在补边后的人脸区域内变换、融合并原地写回，开销随人脸大小而非帧大小变化
+"""
+def paste_back(temp_frame: Frame, swap_frame: Frame, affine_matrix: Any) -> Frame:
+    frame_height, frame_width = temp_frame.shape[:2]
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    start_x, start_y, end_x, end_y = get_paste_back_area(swap_frame, inverse_matrix, frame_width, frame_height)
+    if start_x >= end_x or start_y >= end_y:
+        return temp_frame
+    roi_width = end_x - start_x
+    roi_height = end_y - start_y
+    # 平移逆变换矩阵，使其直接映射到区域坐标
+    roi_matrix = inverse_matrix.copy()
+    roi_matrix[:, 2] -= (start_x, start_y)
+    warp_roi = roop.processors.frame.core.get_frame_buffer('paste_back_frame', (roi_height, roi_width, 3))
+    cv2.warpAffine(swap_frame, roi_matrix, (roi_width, roi_height), dst=warp_roi, borderValue=(0.0, 0.0, 0.0))
+    crop_mask = roop.processors.frame.core.get_frame_buffer('paste_back_crop_mask', swap_frame.shape[:2], numpy.float32)
+    crop_mask.fill(255)
+    mask_roi = roop.processors.frame.core.get_frame_buffer('paste_back_mask', (roi_height, roi_width), numpy.float32)
+    cv2.warpAffine(crop_mask, roi_matrix, (roi_width, roi_height), dst=mask_roi, borderValue=(0.0, 0.0, 0.0))
+    cv2.threshold(mask_roi, 20, 255, cv2.THRESH_BINARY, dst=mask_roi)
+    # 与 insightface 相同的遮罩尺寸计算
+    binary_mask_roi = roop.processors.frame.core.get_frame_buffer('paste_back_binary_mask', (roi_height, roi_width))
+    numpy.copyto(binary_mask_roi, mask_roi, casting='unsafe')
+    _, _, mask_width, mask_height = cv2.boundingRect(binary_mask_roi)
+    mask_size = int(numpy.sqrt(max(mask_width - 1, 0) * max(mask_height - 1, 0)))
+    erode_size = max(mask_size // 10, 10)
+    blur_size = max(mask_size // 20, 5)
+    # 收缩并羽化遮罩边缘，结果写入缓冲池中的数组
+    erode_kernel = roop.processors.frame.core.get_frame_buffer('paste_back_erode_kernel', (erode_size, erode_size))
+    erode_kernel.fill(1)
+    erode_roi = roop.processors.frame.core.get_frame_buffer('paste_back_erode', (roi_height, roi_width), numpy.float32)
+    cv2.erode(mask_roi, erode_kernel, dst=erode_roi)
+    cv2.GaussianBlur(erode_roi, (blur_size * 2 + 1, blur_size * 2 + 1), 0, dst=mask_roi)
+    mask_roi /= 255
+    # temp + mask * (swap - temp)，结果原地写回 temp_frame
+    temp_roi = temp_frame[start_y:end_y, start_x:end_x]
+    merge_roi = roop.processors.frame.core.get_frame_buffer('paste_back_merge', temp_roi.shape, numpy.float32)
+    numpy.subtract(warp_roi, temp_roi, out=merge_roi, dtype=numpy.float32)
+    numpy.multiply(merge_roi, mask_roi[:, :, numpy.newaxis], out=merge_roi)
+    numpy.add(merge_roi, temp_roi, out=merge_roi)
+    numpy.copyto(temp_roi, merge_roi, casting='unsafe')
+    return temp_frame
+
+
+"""
+    换脸结果映射回原帧后的外接框，边缘预留羽化所需的空间，并裁剪到帧内
+"""
+def get_paste_back_area(swap_frame: Frame, inverse_matrix: Any, frame_width: int, frame_height: int) -> Tuple[int, int, int, int]:
+    crop_height, crop_width = swap_frame.shape[:2]
+    corners = cv2.transform(numpy.array([[[0, 0], [crop_width, 0], [0, crop_height], [crop_width, crop_height]]], dtype=numpy.float32), inverse_matrix)[0]
+    padding = max(int(numpy.max(corners.max(axis=0) - corners.min(axis=0))) // 20, 5)
+    start_x, start_y = numpy.maximum(numpy.floor(corners.min(axis=0)).astype(int) - padding, 0)
+    end_x, end_y = numpy.minimum(numpy.ceil(corners.max(axis=0)).astype(int) + padding + 1, (frame_width, frame_height))
+    return int(start_x), int(start_y), int(end_x), int(end_y)
+
+
+"""
+    解析多人映射，reference_frame 按帧号返回参考帧
+"""
+def create_face_map(reference_frame: Callable[[int], Optional[Frame]]) -> List[Tuple[Face, Face]]:
+    face_map = []
+    for face_map_entry in roop.globals.face_map:
+        source_face = get_one_face(cv2.imread(face_map_entry['source']))
+        if face_map_entry.get('reference'):
+            reference_face = get_one_face(cv2.imread(face_map_entry['reference']), face_map_entry.get('reference_face_position', 0))
+        else:
+            temp_frame = reference_frame(face_map_entry.get('reference_frame_number', roop.globals.reference_frame_number))
+            reference_face = get_one_face(temp_frame, face_map_entry.get('reference_face_position', roop.globals.reference_face_position))
+        if source_face and reference_face:
+            face_map.append((source_face, reference_face))
+    return face_map
+
+
+"""
+    预览等逐帧调用时，按目标文件解析多人映射
+"""
+def get_target_face_map() -> List[Tuple[Face, Face]]:
+    if not get_face_map():
+        if is_video(roop.globals.target_path):
+            set_face_map(create_face_map(lambda frame_number: get_video_frame(roop.globals.target_path, frame_number)))
+        else:
+            set_face_map(create_face_map(lambda frame_number: cv2.imread(roop.globals.target_path)))
+    return get_face_map()
 
 
 """
-    处理图像帧
+    查找需要替换的目标人脸，返回 (源人脸, 目标人脸) 列表
 """
-def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
+def find_target_faces(source_face: Face, reference_face: Face, temp_frame: Frame, face_map: Optional[List[Tuple[Face, Face]]] = None, many_faces: Optional[List[Face]] = None) -> List[Tuple[Face, Face]]:
+    # 多人映射，一次检测匹配所有参考人脸
+    if roop.globals.face_map:
+        if face_map is None:
+            face_map = get_target_face_map()
+        similar_faces = find_similar_faces(temp_frame, [map_reference_face for _, map_reference_face in face_map], many_faces)
+        return [(map_source_face, target_face) for (map_source_face, _), target_face in zip(face_map, similar_faces) if target_face]
     # 是否开启多人脸替换
     if roop.globals.many_faces:
-        # 解析图像中的所有人脸
-        many_faces = get_many_faces(temp_frame)
-        if many_faces:
-            # 循环替换人脸
-            for target_face in many_faces:
-                # 换脸
-                temp_frame = swap_face(source_face, target_face, temp_frame)
-    else:
-        # 单人脸替换，解析图像中相似的人脸
-        target_face = find_similar_face(temp_frame, reference_face)
-        if target_face:
-            # 换脸
-            temp_frame = swap_face(source_face, target_face, temp_frame)
+        # 解析图像中的所有人脸，有人脸索引时直接使用索引
+        if many_faces is None:
+            many_faces = get_many_faces(temp_frame)
+        return [(source_face, target_face) for target_face in many_faces or []]
+    # 单人脸替换，解析图像中相似的人脸
+    target_face = find_similar_face(temp_frame, reference_face, many_faces)
+    if target_face:
+        return [(source_face, target_face)]
+    return []
+
+
+"""
+    处理图像帧，没有目标人脸时原样返回传入的帧；many_faces 为调用方已解析的人脸（如实时流中跟踪得到）
+"""
+def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame, many_faces: Optional[List[Face]] = None) -> Frame:
+    target_faces = find_target_faces(source_face, reference_face, temp_frame, many_faces=many_faces)
+    temp_frame = swap_faces(target_faces, temp_frame)
+    # 记录替换过的人脸，后续的人脸增强只处理这些人脸
+    roop.processors.frame.core.record_swapped_frame(temp_frame, [target_face for _, target_face in target_faces])
+    return temp_frame
+
+
+def swap_faces(target_faces: List[Tuple[Face, Face]], temp_frame: Frame) -> Frame:
+    # 循环替换人脸
+    for source_face, target_face in target_faces:
+        # 换脸
+        temp_frame = swap_face(source_face, target_face, temp_frame)
     return temp_frame
 
 
 """
-    批量处理图像帧
+    稀疏关键帧换脸：关键帧完整换脸，之后的帧沿用关键帧对齐后的换脸结果，按当前关键点重新对齐贴回；
+    超过关键帧间隔、人脸移动或表情变化过大、或者帧号不连续时重新完整换脸
+"""
+def swap_faces_keyframe(target_faces: List[Tuple[Face, Face]], temp_frame: Frame, frame_number: int) -> Frame:
+    keyframe_faces = getattr(KEYFRAME, 'faces', [])
+    if getattr(KEYFRAME, 'frame_number', None) != frame_number - 1:
+        keyframe_faces = []
+    next_keyframe_faces = []
+    for source_face, target_face in target_faces:
+        keyframe_face = find_keyframe_face(keyframe_faces, source_face, target_face, frame_number)
+        if keyframe_face is None:
+            swap_frame, affine_matrix = get_face_swapper().get(temp_frame, target_face, source_face, paste_back=False)
+            keyframe_face = KeyframeFace(source_face, target_face.kps, swap_frame, affine_matrix, frame_number)
+            temp_frame = paste_back(temp_frame, swap_frame, affine_matrix)
+        else:
+            affine_matrix = face_align.estimate_norm(target_face.kps, keyframe_face.swap_frame.shape[0])
+            temp_frame = paste_back(temp_frame, keyframe_face.swap_frame, affine_matrix)
+        next_keyframe_faces.append(keyframe_face)
+    KEYFRAME.faces = next_keyframe_faces
+    KEYFRAME.frame_number = frame_number
+    return temp_frame
+
+
+"""
+    查找可以沿用的关键帧人脸：同一张源人脸、仍在关键帧间隔内、且关键点相对关键帧的移动与表情变化都在阈值内
+"""
+def find_keyframe_face(keyframe_faces: List[KeyframeFace], source_face: Face, target_face: Face, frame_number: int) -> Optional[KeyframeFace]:
+    for keyframe_face in keyframe_faces:
+        if keyframe_face.source_face is not source_face or frame_number - keyframe_face.frame_number >= roop.globals.keyframe_interval:
+            continue
+        motion, expression = get_keyframe_motion(keyframe_face, target_face.kps)
+        if motion < roop.globals.keyframe_motion_threshold and expression < KEYFRAME_EXPRESSION_THRESHOLD:
+            return keyframe_face
+    return None
+
+
+"""
+    移动量：关键点平均位移与关键帧人脸关键点跨度之比；
+    表情变化：两组关键点各自对齐到换脸模板后的最大偏差，相似变换（平移、缩放、旋转）已被对齐消除
+"""
+def get_keyframe_motion(keyframe_face: KeyframeFace, kps: Any) -> Tuple[float, float]:
+    face_size = float(numpy.linalg.norm(keyframe_face.kps.max(axis=0) - keyframe_face.kps.min(axis=0)))
+    motion = float(numpy.mean(numpy.linalg.norm(kps - keyframe_face.kps, axis=1))) / max(face_size, 1.0)
+    affine_matrix = face_align.estimate_norm(kps, keyframe_face.swap_frame.shape[0])
+    keyframe_points = cv2.transform(keyframe_face.kps.reshape(1, -1, 2).astype(numpy.float32), keyframe_face.affine_matrix)[0]
+    points = cv2.transform(kps.reshape(1, -1, 2).astype(numpy.float32), affine_matrix)[0]
+    expression = float(numpy.max(numpy.linalg.norm(points - keyframe_points, axis=1)))
+    return motion, expression
+
+
+def clear_keyframe() -> None:
+    KEYFRAME.__dict__.clear()
+
+
+"""
+    批量处理图像帧，没有目标人脸的帧不重新写入
 """
 def process_frames(source_path: str, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
     source_face = get_one_face(cv2.imread(source_path))
     reference_face = get_face_reference()
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(source_face, reference_face, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
-        if update:
-            update()
+    clear_keyframe()
+    with roop.processors.frame.core.write_frames() as write_frame:
+        # 后台预读帧，处理结果交给后台线程写入
+        for temp_frame_path, temp_frame in roop.processors.frame.core.read_frames(temp_frame_paths):
+            target_faces = find_target_faces(source_face, reference_face, temp_frame, many_faces=get_indexed_faces(temp_frame_path, temp_frame))
+            roop.processors.frame.core.record_swapped_faces(temp_frame_path, [target_face for _, target_face in target_faces])
+            if target_faces:
+                if roop.globals.keyframe_interval > 1:
+                    result = swap_faces_keyframe(target_faces, temp_frame, int(os.path.splitext(os.path.basename(temp_frame_path))[0]))
+                else:
+                    result = swap_faces(target_faces, temp_frame)
+                write_frame(temp_frame_path, result)
+            else:
+                roop.processors.frame.core.mark_untouched_frame(temp_frame_path)
+            if update:
+                update()
 
 
 """
@@ -116,8 +359,12 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
     target_frame = cv2.imread(target_path)
     # 从目标图像中解析参考人脸
     reference_face = get_one_face(target_frame, roop.globals.reference_face_position)
+    # 多人映射按当前图片解析，批量处理时各线程互不影响
+    face_map = create_face_map(lambda frame_number: target_frame) if roop.globals.face_map else None
     # 替换 人脸
-    result = process_frame(source_face, reference_face, target_frame)
+    target_faces = find_target_faces(source_face, reference_face, target_frame, face_map)
+    result = swap_faces(target_faces, target_frame)
+    roop.processors.frame.core.record_swapped_faces(output_path, [target_face for _, target_face in target_faces])
     # 显示处理完成的图像
     cv2.imwrite(output_path, result)
 
@@ -133,5 +380,15 @@ def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
         reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
         # 设置参考帧
         set_face_reference(reference_face)
+    # 参考帧按目标视频的帧号读取，与预览和分布式协调节点一致
+    if roop.globals.face_map and not get_face_map():
+        set_face_map(create_face_map(lambda frame_number: get_video_frame(roop.globals.target_path, frame_number)))
     # 处理视频数据
     roop.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames)
+
+
+"""
+    批量处理图片
+"""
+def process_images(source_path: str, target_paths: List[str], output_paths: List[str]) -> None:
+    roop.processors.frame.core.process_images(source_path, target_paths, output_paths, process_image)
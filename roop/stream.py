@@ -0,0 +1,307 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+import cv2
+import numpy
+from tqdm import tqdm
+
+import roop.globals
+from roop.face_analyser import get_one_face, detect_many_faces, embed_many_faces
+from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference, get_face_map, set_face_map, clear_face_map
+from roop.processors.frame.core import get_frame_processors_modules, load_frame_processor_module, read_raw_frame, write_raw_frame
+from roop.typing import Face, Frame
+from roop.utilities import get_video_metadata, get_output_video_arguments
+
+NAME = 'ROOP.STREAM'
+DEFAULT_STREAM_RESOLUTION = (1280, 720)
+DEFAULT_STREAM_FPS = 30.0
+# 超出预算时依次降低的检测尺寸
+DETECTION_SIZES = [(640, 640), (480, 480), (320, 320)]
+# 两次检测之间最多用光流跟踪的帧数
+MAX_DETECTION_INTERVAL = 8
+# 每隔多少帧评估一次是否需要调整
+ADAPT_FRAME_INTERVAL = 15
+# 平均处理耗时低于预算的这个比例时回升画质
+ADAPT_RECOVER_RATIO = 0.6
+LATENCY_PERCENTILES = [50, 90, 99]
+# 读取线程与处理线程轮换使用的帧缓冲数：一个待处理、一个处理中、一个正在读入
+STREAM_BUFFER_TOTAL = 3
+
+# 跟踪状态：上一帧的人脸、灰度图与距上次检测的帧数
+TRACKED_FACES: List[Face] = []
+PREVIOUS_GRAY_FRAME: Optional[Frame] = None
+FRAMES_SINCE_DETECTION = 0
+# 自适应状态：当前检测尺寸档位与检测间隔
+DETECTION_LEVEL = 0
+DETECTION_INTERVAL = 1
+# 输出到管道时保留的真正标准输出，只交给编码器
+STREAM_STDOUT: Optional[int] = None
+
+
+"""
+    解析 WIDTHxHEIGHT 格式的分辨率
+"""
+def parse_stream_resolution(stream_resolution: str) -> Tuple[int, int]:
+    width, _, height = stream_resolution.lower().partition('x')
+    return int(width), int(height)
+
+
+"""
+    流的分辨率与帧率：优先使用参数，本地文件从元数据读取，设备与管道使用默认值
+"""
+def get_stream_format() -> Tuple[int, int, float]:
+    width, height = DEFAULT_STREAM_RESOLUTION
+    fps = DEFAULT_STREAM_FPS
+    if os.path.isfile(roop.globals.stream_input):
+        video_metadata = get_video_metadata(roop.globals.stream_input)
+        if video_metadata.width and video_metadata.height:
+            width, height = video_metadata.width, video_metadata.height
+        fps = video_metadata.fps or fps
+    if roop.globals.stream_resolution:
+        width, height = parse_stream_resolution(roop.globals.stream_resolution)
+    if roop.globals.stream_fps:
+        fps = roop.globals.stream_fps
+    return width, height, fps
+
+
+"""
+    输入端：管道（-）、v4l2 设备或按原速读取的本地文件，统一缩放到固定分辨率和帧率后以 bgr24 输出
+"""
+def open_stream_reader(width: int, height: int, fps: float) -> subprocess.Popen:  # type: ignore[type-arg]
+    stream_input = roop.globals.stream_input
+    commands = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', roop.globals.log_level]
+    if os.path.isfile(stream_input):
+        # 本地文件按原速读取，充当实时流
+        commands.append('-re')
+        if roop.globals.stream_loop:
+            commands.extend(['-stream_loop', '-1'])
+    elif stream_input.startswith('/dev/video'):
+        commands.extend(['-f', 'v4l2'])
+    commands.extend(['-i', 'pipe:0' if stream_input == '-' else stream_input])
+    commands.extend(['-vf', f'scale={width}:{height},fps={fps}', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1'])
+    return subprocess.Popen(commands, stdout=subprocess.PIPE)
+
+
+"""
+    输出端：管道（-）输出 mpegts，v4l2 设备（如 v4l2loopback）直接写入，其余按地址或文件名推断格式
+"""
+def open_stream_writer(width: int, height: int, fps: float) -> subprocess.Popen:  # type: ignore[type-arg]
+    stream_output = roop.globals.stream_output
+    commands = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', roop.globals.log_level]
+    commands.extend(['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0'])
+    if stream_output.startswith('/dev/video'):
+        commands.extend(['-f', 'v4l2', '-pix_fmt', 'yuv420p', stream_output])
+    else:
+        commands.extend(get_output_video_arguments())
+        # 低延迟编码，不缓存参考帧
+        if roop.globals.output_video_encoder in ['libx264', 'libx265']:
+            commands.extend(['-preset', 'ultrafast', '-tune', 'zerolatency'])
+        if stream_output == '-':
+            commands.extend(['-f', 'mpegts', 'pipe:1'])
+        elif '://' in stream_output:
+            commands.extend(['-f', 'mpegts', stream_output])
+        else:
+            commands.extend(['-y', stream_output])
+    return subprocess.Popen(commands, stdin=subprocess.PIPE, stdout=STREAM_STDOUT)
+
+
+"""
+    输出到管道（-）时，把进程的标准输出（状态信息、模型加载时库的打印以及其他子进程）改到 stderr，
+    真正的标准输出只留给编码器写入 mpegts
+"""
+def redirect_stream_stdout() -> None:
+    global STREAM_STDOUT
+
+    if roop.globals.stream_output != '-' or STREAM_STDOUT is not None:
+        return
+    sys.stdout.flush()
+    STREAM_STDOUT = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+
+"""
+    检测当前帧的所有人脸并计算识别特征，检测尺寸随自适应档位变化
+"""
+def detect_stream_faces(frame: Frame) -> List[Face]:
+    many_faces = detect_many_faces(frame, DETECTION_SIZES[DETECTION_LEVEL])
+    if many_faces:
+        embed_many_faces(frame, many_faces)
+    return many_faces
+
+
+"""
+    用金字塔光流把上一帧的人脸关键点推到当前帧，人脸框随关键点平移，识别特征沿用；
+    任一关键点跟丢时返回 None，由调用方重新检测
+"""
+def track_faces(gray_frame: Frame) -> Optional[List[Face]]:
+    if not TRACKED_FACES:
+        return []
+    points = numpy.concatenate([face.kps for face in TRACKED_FACES]).astype(numpy.float32).reshape(-1, 1, 2)
+    next_points, status, _ = cv2.calcOpticalFlowPyrLK(PREVIOUS_GRAY_FRAME, gray_frame, points, None, winSize=(21, 21), maxLevel=3)
+    if next_points is None or not status.all():
+        return None
+    many_faces = []
+    for face, kps in zip(TRACKED_FACES, next_points.reshape(-1, 5, 2)):
+        offset = numpy.mean(kps - face.kps, axis=0)
+        many_faces.append(Face(bbox=face.bbox + numpy.tile(offset, 2), kps=kps, det_score=face.det_score, embedding=face.embedding))
+    return many_faces
+
+
+"""
+    当前帧的人脸：检测间隔内用光流跟踪代替检测
+"""
+def get_stream_faces(frame: Frame) -> List[Face]:
+    global TRACKED_FACES, PREVIOUS_GRAY_FRAME, FRAMES_SINCE_DETECTION
+
+    gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    many_faces = None
+    if PREVIOUS_GRAY_FRAME is not None and FRAMES_SINCE_DETECTION < DETECTION_INTERVAL:
+        many_faces = track_faces(gray_frame)
+    if many_faces is None:
+        many_faces = detect_stream_faces(frame)
+        FRAMES_SINCE_DETECTION = 0
+    FRAMES_SINCE_DETECTION += 1
+    TRACKED_FACES = many_faces
+    PREVIOUS_GRAY_FRAME = gray_frame
+    return many_faces
+
+
+"""
+    根据近期平均处理耗时调整：超出预算先降低检测尺寸，再拉长检测间隔；
+    明显低于预算时按相反顺序恢复，仍然跟不上的帧由读取线程丢弃
+"""
+def adapt_stream_quality(processing_time: float, latency_budget: float) -> None:
+    global DETECTION_LEVEL, DETECTION_INTERVAL
+
+    if processing_time > latency_budget:
+        if DETECTION_LEVEL < len(DETECTION_SIZES) - 1:
+            DETECTION_LEVEL += 1
+        elif DETECTION_INTERVAL < MAX_DETECTION_INTERVAL:
+            DETECTION_INTERVAL *= 2
+    elif processing_time < latency_budget * ADAPT_RECOVER_RATIO:
+        if DETECTION_INTERVAL > 1:
+            DETECTION_INTERVAL //= 2
+        elif DETECTION_LEVEL > 0:
+            DETECTION_LEVEL -= 1
+
+
+def clear_stream_state() -> None:
+    global TRACKED_FACES, PREVIOUS_GRAY_FRAME, FRAMES_SINCE_DETECTION, DETECTION_LEVEL, DETECTION_INTERVAL
+
+    TRACKED_FACES = []
+    PREVIOUS_GRAY_FRAME = None
+    FRAMES_SINCE_DETECTION = 0
+    DETECTION_LEVEL = 0
+    DETECTION_INTERVAL = 1
+
+
+"""
+    参考人脸与多人映射都取自流中第一张有人脸的帧
+"""
+def prepare_stream_reference(frame: Frame) -> bool:
+    if roop.globals.face_map:
+        if not get_face_map():
+            set_face_map(load_frame_processor_module('face_swapper').create_face_map(lambda frame_number: frame))
+        return bool(get_face_map())
+    if not roop.globals.many_faces and not get_face_reference():
+        set_face_reference(get_one_face(frame, roop.globals.reference_face_position))
+    return roop.globals.many_faces or bool(get_face_reference())
+
+
+"""
+    实时处理：读取线程只保留最新一帧，处理跟不上时旧帧直接丢弃；
+    每帧在延迟预算内完成检测或跟踪与各处理器的 process_frame，写入输出端，结束时报告端到端延迟分位数
+"""
+def process_stream(source_path: str) -> bool:
+    width, height, fps = get_stream_format()
+    latency_budget = (roop.globals.stream_latency_budget or 1000 / fps) / 1000
+    source_face = get_one_face(cv2.imread(source_path))
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+    reader = open_stream_reader(width, height, fps)
+    writer = open_stream_writer(width, height, fps)
+    frame_buffers = [numpy.empty((height, width, 3), dtype=numpy.uint8) for _ in range(STREAM_BUFFER_TOTAL)]
+    condition = threading.Condition()
+    # 待处理帧：(缓冲编号, 读入完成时刻)
+    pending: List[Tuple[int, float]] = []
+    stream_state = {'finished': False, 'dropped': 0, 'processing_index': -1}
+
+    def read_stream() -> None:
+        while True:
+            with condition:
+                index = next(index for index in range(STREAM_BUFFER_TOTAL) if index != stream_state['processing_index'] and all(index != pending_index for pending_index, _ in pending))
+            if not read_raw_frame(reader.stdout, frame_buffers[index]):  # type: ignore[arg-type]
+                break
+            with condition:
+                # 上一帧还没被取走，说明处理跟不上，丢弃旧帧
+                if pending:
+                    pending.clear()
+                    stream_state['dropped'] += 1
+                pending.append((index, time.perf_counter()))
+                condition.notify()
+        with condition:
+            stream_state['finished'] = True
+            condition.notify()
+
+    reader_thread = threading.Thread(target=read_stream, daemon=True)
+    reader_thread.start()
+    latencies: List[float] = []
+    processing_times: List[float] = []
+    clear_stream_state()
+    progress_bar_format = '{l_bar}{n_fmt} frames [{elapsed}, {rate_fmt}{postfix}]'
+    try:
+        with tqdm(desc='Streaming', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format, file=sys.stderr) as progress:
+            while True:
+                with condition:
+                    while not pending and not stream_state['finished']:
+                        condition.wait()
+                    if not pending:
+                        break
+                    index, capture_time = pending.pop()
+                    stream_state['processing_index'] = index
+                start_time = time.perf_counter()
+                temp_frame = frame_buffers[index]
+                if prepare_stream_reference(temp_frame):
+                    many_faces = get_stream_faces(temp_frame)
+                    for frame_processor in frame_processors:
+                        temp_frame = frame_processor.process_frame(source_face, get_face_reference(), temp_frame, many_faces)
+                write_raw_frame(writer.stdin, temp_frame)  # type: ignore[arg-type]
+                end_time = time.perf_counter()
+                with condition:
+                    stream_state['processing_index'] = -1
+                latencies.append(end_time - capture_time)
+                processing_times.append(end_time - start_time)
+                if len(processing_times) % ADAPT_FRAME_INTERVAL == 0:
+                    adapt_stream_quality(float(numpy.mean(processing_times[-ADAPT_FRAME_INTERVAL:])), latency_budget)
+                progress.set_postfix(det_size=DETECTION_SIZES[DETECTION_LEVEL][0], interval=DETECTION_INTERVAL, dropped=stream_state['dropped'], refresh=False)
+                progress.update()
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    finally:
+        reader.kill()
+        if writer.stdin:
+            try:
+                writer.stdin.close()
+            except BrokenPipeError:
+                pass
+        writer.wait()
+        reader.wait()
+        clear_stream_state()
+        clear_face_reference()
+        clear_face_map()
+    report_stream_latency(latencies, processing_times, stream_state['dropped'])
+    return bool(latencies)
+
+
+"""
+    端到端延迟从帧读入完成到写入输出端为止，不含编解码器内部缓冲；报告输出到 stderr，以免混入管道输出
+"""
+def report_stream_latency(latencies: List[float], processing_times: List[float], dropped_total: int) -> None:
+    if not latencies:
+        print(f'[{NAME}] No frames processed.', file=sys.stderr)
+        return
+    latency_percentiles = numpy.percentile(numpy.array(latencies) * 1000, LATENCY_PERCENTILES)
+    print(f'[{NAME}] Processed {len(latencies)} frames, dropped {dropped_total} frames.', file=sys.stderr)
+    print(f'[{NAME}] Latency ' + ', '.join(f'p{percentile} {value:.1f}ms' for percentile, value in zip(LATENCY_PERCENTILES, latency_percentiles)) + f', mean processing {numpy.mean(processing_times) * 1000:.1f}ms.', file=sys.stderr)
@@ -1,21 +1,71 @@
 import glob
+import hashlib
+import json
 import mimetypes
 import os
 import platform
 import shutil
 import ssl
 import subprocess
-import urllib
+import threading
+import time
+from collections import deque
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+import psutil
 from tqdm import tqdm
 
 import roop.globals
+from roop.model_store import download_models
 
 # 临时目录名
 TEMP_DIRECTORY = 'temp'
 # 临时视频文件名
 TEMP_VIDEO_FILE = 'temp.mp4'
+# 输出编码器对应的编码格式，用于判断能否直接复制码流
+OUTPUT_VIDEO_CODECS = {
+    'libx264': 'h264',
+    'libx265': 'hevc',
+    'libvpx-vp9': 'vp9',
+    'h264_nvenc': 'h264',
+    'hevc_nvenc': 'hevc'
+}
+# 内存文件系统
+TMPFS_DIRECTORY = '/dev/shm'
+# 临时帧相对 rgb24 原始大小的估算压缩比
+TEMP_FRAME_COMPRESSION_RATIOS = {'jpg': 0.15, 'png': 0.6}
+# 选定的临时目录根路径，为空时使用目标文件所在目录
+TEMP_DIRECTORY_ROOT: Optional[str] = None
+
+
+class FfmpegResult(NamedTuple):
+    stage: str
+    returncode: int
+    elapsed: float
+    error: str
+
+
+class VideoMetadata(NamedTuple):
+    fps: float
+    frame_total: int
+    duration: float
+    width: int
+    height: int
+    pixel_format: str
+    video_codec: str
+    profile: str
+    time_base: str
+    has_audio: bool
+
+
+# 按 (路径, 修改时间) 缓存的视频元数据
+VIDEO_METADATA: Dict[Tuple[str, float], VideoMetadata] = {}
+# 每个 ffmpeg 阶段的耗时与错误
+FFMPEG_RESULTS: List[FfmpegResult] = []
+# 正在运行的 ffmpeg 进程，取消时统一终止
+FFMPEG_PROCESSES: Set[subprocess.Popen] = set()  # type: ignore[type-arg]
+FFMPEG_CANCEL = threading.Event()
+FFMPEG_ERROR_LINES = 20
 
 # monkey patch ssl for mac
 if platform.system().lower() == 'darwin':
@@ -23,83 +73,383 @@ if platform.system().lower() == 'darwin':
 
 
 """
-    调用 音视频处理工具，Ffmpeg
+    调用 音视频处理工具，Ffmpeg：流式读取 -progress 输出显示进度，只保留最后几行错误信息
 """
-def run_ffmpeg(args: List[str]) -> bool:
-    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level]
+def run_ffmpeg(args: List[str], stage: str = 'ffmpeg', frame_total: int = 0) -> bool:
+    commands = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', roop.globals.log_level, '-progress', 'pipe:1']
     commands.extend(args)
+    if FFMPEG_CANCEL.is_set():
+        return False
+    start_time = time.perf_counter()
     try:
-        subprocess.check_output(commands, stderr=subprocess.STDOUT)
-        return True
-    except Exception:
+        process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as exception:
+        return record_ffmpeg_result(stage, -1, start_time, str(exception))
+    FFMPEG_PROCESSES.add(process)
+    error_lines: Deque[str] = deque(maxlen=FFMPEG_ERROR_LINES)
+    error_thread = threading.Thread(target=lambda: error_lines.extend(line.decode(errors='replace').rstrip() for line in process.stderr), daemon=True)  # type: ignore[union-attr]
+    error_thread.start()
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    with tqdm(total=frame_total or None, desc=stage.capitalize(), unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        progress_values: Dict[str, str] = {}
+        for line in process.stdout:  # type: ignore[union-attr]
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            progress_values[key] = value
+            # 每个进度块以 progress=continue|end 结尾
+            if key == 'progress':
+                update_ffmpeg_progress(progress, progress_values)
+    returncode = process.wait()
+    error_thread.join()
+    FFMPEG_PROCESSES.discard(process)
+    if FFMPEG_CANCEL.is_set():
+        error_lines.append('cancelled')
+    return record_ffmpeg_result(stage, returncode, start_time, '\n'.join(error_lines))
+
+
+"""
+    将 ffmpeg 的进度块同步到进度条：已处理帧数、帧率、速度与剩余时间
+"""
+def update_ffmpeg_progress(progress: Any, progress_values: Dict[str, str]) -> None:
+    frame_number = progress_values.get('frame', '')
+    if frame_number.isdigit():
+        progress.update(int(frame_number) - progress.n)
+    progress.set_postfix({
+        'fps': progress_values.get('fps', 'N/A'),
+        'speed': progress_values.get('speed', 'N/A').strip()
+    })
+
+
+"""
+    记录 ffmpeg 阶段的结果，失败时输出错误信息
+"""
+def record_ffmpeg_result(stage: str, returncode: int, start_time: float, error: str) -> bool:
+    ffmpeg_result = FfmpegResult(stage, returncode, time.perf_counter() - start_time, error if returncode else '')
+    FFMPEG_RESULTS.append(ffmpeg_result)
+    if returncode:
+        print(f'[ROOP.FFMPEG] {stage} failed with code {returncode} after {ffmpeg_result.elapsed:.1f}s: {error}')
+    return returncode == 0
+
+
+def get_ffmpeg_results() -> List[FfmpegResult]:
+    return FFMPEG_RESULTS
+
+
+"""
+    取消所有正在运行和之后的 ffmpeg 调用
+"""
+def cancel_ffmpeg() -> None:
+    FFMPEG_CANCEL.set()
+    for process in list(FFMPEG_PROCESSES):
+        process.terminate()
+
+
+def clear_ffmpeg() -> None:
+    FFMPEG_CANCEL.clear()
+    FFMPEG_RESULTS.clear()
+
+
+"""
+    探测视频元数据：一次 ffprobe 调用得到帧率、帧数、时长、分辨率、像素格式与是否有音频，按路径和修改时间缓存
+"""
+def get_video_metadata(target_path: str) -> VideoMetadata:
+    metadata_key = (os.path.abspath(target_path), os.path.getmtime(target_path))
+    if metadata_key not in VIDEO_METADATA:
+        command = ['ffprobe', '-v', 'error', '-show_streams', '-show_format', '-of', 'json', target_path]
+        try:
+            probe = json.loads(subprocess.check_output(command))
+        except (subprocess.CalledProcessError, ValueError):
+            return VideoMetadata(30, 0, 0, 0, 0, '', '', '', '', False)
+        VIDEO_METADATA[metadata_key] = parse_video_metadata(probe)
+    return VIDEO_METADATA[metadata_key]
+
+
+def parse_video_metadata(probe: Dict[str, Any]) -> VideoMetadata:
+    streams = probe.get('streams', [])
+    video_stream: Dict[str, Any] = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    fps = 30.0
+    try:
+        numerator, denominator = map(int, video_stream.get('r_frame_rate', '').split('/'))
+        fps = numerator / denominator
+    except (ValueError, ZeroDivisionError):
         pass
-    return False
+    duration = float(video_stream.get('duration') or probe.get('format', {}).get('duration') or 0)
+    frame_total = int(video_stream.get('nb_frames') or duration * fps)
+    return VideoMetadata(
+        fps=fps,
+        frame_total=frame_total,
+        duration=duration,
+        width=int(video_stream.get('width', 0)),
+        height=int(video_stream.get('height', 0)),
+        pixel_format=video_stream.get('pix_fmt', ''),
+        video_codec=video_stream.get('codec_name', ''),
+        profile=video_stream.get('profile', ''),
+        time_base=video_stream.get('time_base', ''),
+        has_audio=any(stream.get('codec_type') == 'audio' for stream in streams)
+    )
 
 
 """
     探测，目标帧率
 """
 def detect_fps(target_path: str) -> float:
-    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
-    output = subprocess.check_output(command).decode().strip().split('/')
-    try:
-        numerator, denominator = map(int, output)
-        return numerator / denominator
-    except Exception:
-        pass
-    return 30
+    return get_video_metadata(target_path).fps
 
 
 """
     提取帧
 """
-def extract_frames(target_path: str, fps: float = 30) -> bool:
+def extract_frames(target_path: str, fps: float = 30, trim_range: Optional[Tuple[float, Optional[float]]] = None) -> bool:
     temp_directory_path = get_temp_directory_path(target_path)
     temp_frame_quality = roop.globals.temp_frame_quality * 31 // 100
-    return run_ffmpeg(['-hwaccel', 'auto', '-i', target_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', 'fps=' + str(fps), os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+    commands = ['-hwaccel', 'auto']
+    # 只解码裁剪范围，输入端定位，开销随范围长度而非视频长度变化
+    if trim_range:
+        start_time, end_time = trim_range
+        commands.extend(['-ss', str(start_time)])
+        if end_time is not None:
+            commands.extend(['-t', str(end_time - start_time)])
+    commands.extend(['-i', target_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', 'fps=' + str(fps), os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+    return run_ffmpeg(commands, 'extract', estimate_frame_total(target_path, fps, trim_range))
+
+
+"""
+    按帧号提取 [start_frame, end_frame) 的帧：输入端先定位到区间之前，保留原始时间戳，
+    fps 滤镜输出的 pts 就是整段视频中的帧序号，据此精确选取，相邻区间之间不会重复或遗漏帧
+"""
+def extract_frame_range(target_path: str, fps: float, start_frame: int, end_frame: int) -> bool:
+    temp_directory_path = get_temp_directory_path(target_path)
+    temp_frame_quality = roop.globals.temp_frame_quality * 31 // 100
+    # 前后各预留一秒，定位误差不会丢掉区间边缘的帧
+    seek_time = max(start_frame / fps - 1, 0)
+    commands = ['-hwaccel', 'auto', '-ss', str(seek_time), '-t', str(end_frame / fps - seek_time + 1), '-copyts', '-start_at_zero', '-i', target_path]
+    commands.extend(['-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', f'fps={fps},select=between(pts\\,{start_frame}\\,{end_frame - 1})', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+    return run_ffmpeg(commands, 'extract', end_frame - start_frame)
+
+
+"""
+    估算提取的帧数，用于显示进度
+"""
+def estimate_frame_total(target_path: str, fps: float, trim_range: Optional[Tuple[float, Optional[float]]] = None) -> int:
+    duration = get_video_metadata(target_path).duration
+    if trim_range:
+        start_time, end_time = trim_range
+        duration = (end_time if end_time is not None else duration) - start_time
+    return max(int(duration * fps), 0)
+
+
+"""
+    探测，指定区间内的关键帧时间
+"""
+def detect_keyframe_times(target_path: str, read_interval: str) -> List[float]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals', read_interval, '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', target_path]
+    keyframe_times = []
+    for line in subprocess.check_output(command).decode().splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ['', 'N/A']:
+            keyframe_times.append(float(pts_time))
+    return keyframe_times
+
+
+"""
+    探测，关键帧的解码时间，没有找到时沿用显示时间
+"""
+def detect_decode_time(target_path: str, keyframe_time: float) -> float:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals', f'{max(keyframe_time - 1, 0)}%{keyframe_time + 1}', '-show_entries', 'packet=pts_time,dts_time,flags', '-of', 'csv=p=0', target_path]
+    for line in subprocess.check_output(command).decode().splitlines():
+        pts_time, _, remainder = line.partition(',')
+        dts_time, _, flags = remainder.partition(',')
+        if 'K' in flags and pts_time not in ['', 'N/A'] and dts_time not in ['', 'N/A'] and abs(float(pts_time) - keyframe_time) < 0.001:
+            return float(dts_time)
+    return keyframe_time
+
+
+"""
+    将裁剪范围（帧号）向外对齐到关键帧，以便拼接时直接复制首尾的码流，结束时间为 None 表示到视频结尾
+"""
+def get_trim_range(target_path: str, fps: float) -> Tuple[float, Optional[float]]:
+    start_time = 0.0
+    end_time = None
+    if roop.globals.trim_frame_start:
+        trim_start_time = roop.globals.trim_frame_start / fps
+        keyframe_times = [keyframe_time for keyframe_time in detect_keyframe_times(target_path, f'{max(trim_start_time - 60, 0)}%{trim_start_time}') if keyframe_time <= trim_start_time]
+        start_time = max(keyframe_times, default=0.0)
+    if roop.globals.trim_frame_end:
+        trim_end_time = roop.globals.trim_frame_end / fps
+        keyframe_times = [keyframe_time for keyframe_time in detect_keyframe_times(target_path, f'{trim_end_time}%+60') if keyframe_time >= trim_end_time]
+        end_time = min(keyframe_times, default=None)
+    return start_time, end_time
+
+
+"""
+    从对齐后的片段帧中挑出真正需要处理的帧，其余帧原样参与拼接
+"""
+def get_trim_frame_paths(temp_frame_paths: List[str], fps: float, start_time: float) -> List[str]:
+    frame_offset = round(start_time * fps) - 1
+    trim_frame_paths = []
+    for temp_frame_path in temp_frame_paths:
+        frame_number = int(os.path.splitext(os.path.basename(temp_frame_path))[0]) + frame_offset
+        if frame_number >= (roop.globals.trim_frame_start or 0) and (not roop.globals.trim_frame_end or frame_number < roop.globals.trim_frame_end):
+            trim_frame_paths.append(temp_frame_path)
+    return trim_frame_paths
 
 
 """
     生成 视频
 """
-def create_video(target_path: str, fps: float = 30) -> bool:
+def create_video(target_path: str, fps: float = 30, mux_audio: bool = False, time_base: Optional[str] = None) -> bool:
     temp_output_path = get_temp_output_path(target_path)
     temp_directory_path = get_temp_directory_path(target_path)
+    commands = ['-hwaccel', 'auto', '-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)]
+    # 编码时直接从目标文件映射音频，省去单独的音频合成
+    if mux_audio:
+        commands.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0'])
+    commands.extend(get_output_video_arguments())
+    # 需要与目标的码流拼接时沿用目标的时间基
+    if time_base:
+        commands.extend(['-video_track_timescale', time_base.rpartition('/')[2]])
+    commands.extend(['-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
+    return run_ffmpeg(commands, 'encode', len(get_temp_frame_paths(target_path)))
+
+
+"""
+    输出视频的编码参数
+"""
+def get_output_video_arguments() -> List[str]:
     output_video_quality = (roop.globals.output_video_quality + 1) * 51 // 100
-    commands = ['-hwaccel', 'auto', '-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format), '-c:v', roop.globals.output_video_encoder]
+    commands = ['-c:v', roop.globals.output_video_encoder]
     if roop.globals.output_video_encoder in ['libx264', 'libx265', 'libvpx']:
         commands.extend(['-crf', str(output_video_quality)])
     if roop.globals.output_video_encoder in ['h264_nvenc', 'hevc_nvenc']:
         commands.extend(['-cq', str(output_video_quality)])
-    commands.extend(['-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
-    return run_ffmpeg(commands)
+    commands.extend(['-pix_fmt', 'yuv420p'])
+    return commands
 
 
 """
-    备份音频
+    将处理后的片段拼回原视频，码流参数与处理后的片段一致时首尾直接复制码流，否则只重新编码首尾
 """
-def restore_audio(target_path: str, output_path: str) -> None:
+def splice_video(target_path: str, start_time: float, end_time: Optional[float], mux_audio: bool = False) -> bool:
+    temp_output_path = get_temp_output_path(target_path)
+    temp_directory_path = get_temp_directory_path(target_path)
+    video_codec_arguments = ['-c:v', 'copy']
+    if not is_splice_compatible(get_video_metadata(target_path), get_video_metadata(temp_output_path)):
+        video_codec_arguments = get_output_video_arguments()
+    splice_paths = []
+    if start_time > 0:
+        head_path = os.path.join(temp_directory_path, 'head.mp4')
+        head_duration = start_time
+        # 复制码流按解码时间截断，存在 B 帧时关键帧先于前面的帧解码，要在关键帧的解码时间之前截断
+        if video_codec_arguments == ['-c:v', 'copy']:
+            head_duration = max(detect_decode_time(target_path, start_time) - 0.5 / get_video_metadata(target_path).fps, 0)
+        if not run_ffmpeg(['-i', target_path, '-t', str(head_duration), '-map', '0:v:0', *video_codec_arguments, '-y', head_path], 'splice'):
+            return False
+        splice_paths.append(head_path)
+    splice_paths.append(temp_output_path)
+    if end_time is not None:
+        tail_path = os.path.join(temp_directory_path, 'tail.mp4')
+        if not run_ffmpeg(['-ss', str(end_time), '-i', target_path, '-map', '0:v:0', *video_codec_arguments, '-y', tail_path], 'splice'):
+            return False
+        splice_paths.append(tail_path)
+    return concat_video(target_path, splice_paths, mux_audio, 'splice')
+
+
+"""
+    首尾能否直接复制码流：编码格式、像素格式、档次、时间基与分辨率都要与处理后的片段一致，
+    否则（例如 10 位或 yuv444 的目标）拼接出的文件可能无法播放
+"""
+def is_splice_compatible(target_metadata: VideoMetadata, output_metadata: VideoMetadata) -> bool:
+    return target_metadata.video_codec == OUTPUT_VIDEO_CODECS.get(roop.globals.output_video_encoder) == output_metadata.video_codec \
+        and target_metadata.pixel_format == output_metadata.pixel_format \
+        and target_metadata.profile == output_metadata.profile \
+        and target_metadata.time_base == output_metadata.time_base \
+        and (target_metadata.width, target_metadata.height) == (output_metadata.width, output_metadata.height)
+
+
+"""
+    按顺序无损拼接多段视频作为临时输出，可同时映射完整的目标音频
+"""
+def concat_video(target_path: str, video_paths: List[str], mux_audio: bool = False, stage: str = 'concat') -> bool:
     temp_output_path = get_temp_output_path(target_path)
-    done = run_ffmpeg(['-hwaccel', 'auto', '-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
-    if not done:
-        move_temp(target_path, output_path)
+    temp_directory_path = get_temp_directory_path(target_path)
+    concat_list_path = os.path.join(temp_directory_path, 'concat.txt')
+    with open(concat_list_path, 'w') as concat_list_file:
+        concat_list_file.writelines(f"file '{os.path.abspath(video_path)}'\n" for video_path in video_paths)
+    concat_output_path = os.path.join(temp_directory_path, 'concat.mp4')
+    commands = ['-f', 'concat', '-safe', '0', '-i', concat_list_path]
+    # 拼接时一并映射完整的目标音频
+    if mux_audio:
+        commands.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0'])
+    commands.extend(['-c:v', 'copy', '-y', concat_output_path])
+    if not run_ffmpeg(commands, stage):
+        return False
+    shutil.move(concat_output_path, temp_output_path)
+    return True
 
 
 """
-    临时帧的保存路径
+    临时帧的保存路径，按帧号排序：各线程分到连续的帧，关键帧复用才能沿用上一帧的结果
 """
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.' + roop.globals.temp_frame_format)))
+    temp_frame_paths = glob.glob((os.path.join(glob.escape(temp_directory_path), '*.' + roop.globals.temp_frame_format)))
+    return sorted(temp_frame_paths, key=lambda temp_frame_path: int(os.path.splitext(os.path.basename(temp_frame_path))[0]))
 
 
 """
-    临时目录 路径
+    临时目录 路径；共用的临时目录中不同目录下的同名目标会冲突，目录名附加目标绝对路径的哈希
 """
 def get_temp_directory_path(target_path: str) -> str:
     target_name, _ = os.path.splitext(os.path.basename(target_path))
-    target_directory_path = os.path.dirname(target_path)
-    return os.path.join(target_directory_path, TEMP_DIRECTORY, target_name)
+    if TEMP_DIRECTORY_ROOT:
+        target_hash = hashlib.sha1(os.path.abspath(target_path).encode()).hexdigest()[:12]
+        return os.path.join(TEMP_DIRECTORY_ROOT, TEMP_DIRECTORY, f'{target_name}-{target_hash}')
+    return os.path.join(os.path.dirname(target_path), TEMP_DIRECTORY, target_name)
+
+
+"""
+    估算临时帧占用的空间
+"""
+def estimate_temp_frames_size(target_path: str, fps: float = 30, trim_range: Optional[Tuple[float, Optional[float]]] = None) -> int:
+    video_metadata = get_video_metadata(target_path)
+    # 裁剪时只提取对齐后的范围
+    frame_total = estimate_frame_total(target_path, fps, trim_range)
+    frame_size = video_metadata.width * video_metadata.height * 3 * TEMP_FRAME_COMPRESSION_RATIOS.get(roop.globals.temp_frame_format, 1)
+    # 预留一成余量给临时视频
+    return int(frame_total * frame_size * 1.1)
+
+
+"""
+    在提取帧之前选定临时目录：auto 时优先使用内存文件系统，空间不足则回退到目标文件所在目录
+"""
+def select_temp_directory(target_path: str, fps: float = 30, trim_range: Optional[Tuple[float, Optional[float]]] = None) -> bool:
+    global TEMP_DIRECTORY_ROOT
+
+    temp_frames_size = estimate_temp_frames_size(target_path, fps, trim_range)
+    target_directory_path = os.path.dirname(os.path.abspath(target_path))
+    if roop.globals.temp_directory == 'auto':
+        temp_directory_roots = [TMPFS_DIRECTORY, target_directory_path]
+    elif roop.globals.temp_directory:
+        Path(roop.globals.temp_directory).mkdir(parents=True, exist_ok=True)
+        temp_directory_roots = [roop.globals.temp_directory]
+    else:
+        temp_directory_roots = [target_directory_path]
+    for temp_directory_root in temp_directory_roots:
+        if get_free_space(temp_directory_root) > temp_frames_size:
+            TEMP_DIRECTORY_ROOT = temp_directory_root
+            return True
+    return False
+
+
+"""
+    目录可用空间，内存文件系统同时受可用内存限制
+"""
+def get_free_space(directory_path: str) -> int:
+    if not os.path.isdir(directory_path):
+        return 0
+    free_space = shutil.disk_usage(directory_path).free
+    if directory_path == TMPFS_DIRECTORY:
+        return min(free_space, psutil.virtual_memory().available)
+    return free_space
 
 
 """
@@ -117,11 +467,25 @@ def normalize_output_path(source_path: str, target_path: str, output_path: str)
     if source_path and target_path and output_path:
         source_name, _ = os.path.splitext(os.path.basename(source_path))
         target_name, target_extension = os.path.splitext(os.path.basename(target_path))
+        if is_batch_target(target_path):
+            return output_path
         if os.path.isdir(output_path):
             return os.path.join(output_path, source_name + '-' + target_name + target_extension)
     return output_path
 
 
+"""
+    读取多人映射的 JSON 文件，格式为
+    [{"source": "a.jpg", "reference": "person.jpg"}, {"source": "b.jpg", "reference_frame_number": 0, "reference_face_position": 1}]
+"""
+def load_face_map(face_map_path: str) -> List[Dict[str, Any]]:
+    with open(face_map_path) as face_map_file:
+        face_map = json.load(face_map_file)
+    if not isinstance(face_map, list) or not all(isinstance(face_map_entry, dict) and face_map_entry.get('source') for face_map_entry in face_map):
+        raise ValueError('face map must be a list of objects with a source')
+    return face_map
+
+
 """
     创建临时路径
 """
@@ -170,6 +534,26 @@ def is_image(image_path: str) -> bool:
     return False
 
 
+"""
+    判断目标是否为包含图片的目录或通配符；已存在的文件按字面路径处理，即使文件名中含有通配字符（如 photo[1].jpg）
+"""
+def is_batch_target(target_path: str) -> bool:
+    if not target_path or os.path.isfile(target_path):
+        return False
+    if os.path.isdir(target_path) or glob.has_magic(target_path):
+        return bool(get_batch_target_paths(target_path))
+    return False
+
+
+"""
+    展开目录或通配符，得到所有目标图片
+"""
+def get_batch_target_paths(target_path: str) -> List[str]:
+    if os.path.isdir(target_path):
+        target_path = os.path.join(glob.escape(target_path), '*')
+    return sorted(image_path for image_path in glob.glob(target_path) if is_image(image_path))
+
+
 """
     判断文件是否是视频
 """
@@ -181,24 +565,11 @@ def is_video(video_path: str) -> bool:
 
 
 """
-    根据条件下载文件，不存在才下载
-"""
-def conditional_download(download_directory_path: str, urls: List[str]) -> None:
-    if not os.path.exists(download_directory_path):
-        os.makedirs(download_directory_path)
-    for url in urls:
-        # 下载文件存放路径，basename 是去url的最后一级path，也就是文件名
-        download_file_path = os.path.join(download_directory_path, os.path.basename(url))
-        # 文件不存在就下载
-        if not os.path.exists(download_file_path):
-            # 开始下载
-            request = urllib.request.urlopen(url)  # type: ignore[attr-defined]
-            # 获取文件大小
-            total = int(request.headers.get('Content-Length', 0))
-            # 下载进度条
-            with tqdm(total=total, desc='Downloading', unit='B', unit_scale=True, unit_divisor=1024) as progress:
-                # 下载
-                urllib.request.urlretrieve(url, download_file_path, reporthook=lambda count, block_size, total_size: progress.update(block_size))  # type: ignore[attr-defined]
+    根据条件下载文件：并发下载、断点续传并校验 SHA-256，可从 --model-mirror 指定的镜像获取，失败时返回 False
+"""
+def conditional_download(download_directory_path: str, urls: List[str]) -> bool:
+    return download_models(download_directory_path, urls)
+
 
 """
     计算相对路径